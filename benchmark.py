@@ -0,0 +1,501 @@
+import os
+import re
+import sys
+import json
+import hashlib
+import argparse
+import tempfile
+import subprocess
+import collections
+import numpy as np
+import pandas as pd
+import profiling
+import lipid_preprocessing as lp
+
+
+'''
+    Benchmark suite: synthetic feature tables (m/z, mode, adduct, RT), a
+    SwissLipids-like hierarchy and a ChEBI acyclic graph are generated from a
+    seed, every stage is timed against a local stub of the lipyd database and
+    the wall time, peak memory, throughput and a digest of the output of every
+    stage are compared against a saved baseline. The per-feature reference
+    implementations are checked to give the same output as the vectorized
+    stages, and the representatives run once more on a hierarchy without
+    ambiguous subspecies, where the no-species fallback is used
+
+    python benchmark.py --sizes 1000 10000 100000 --save-baseline results/benchmark_baseline.json
+    python benchmark.py --sizes 1000 10000 100000 --baseline results/benchmark_baseline.json
+    python benchmark.py --import-times
+'''
+
+BENCHMARK_VERSION = 2
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+# Share of the SwissLipids IDs on every level, from the top of the hierarchy
+HIERARCHY_LEVELS = [("Category", 0.001),
+                    ("Class", 0.01),
+                    ("Species", 0.2),
+                    ("Molecular subspecies", 0.3),
+                    ("Isomeric subspecies", 0.489)]
+
+# Dependencies which should only be imported by the stages that use them
+HEAVY_MODULES = ["lipyd", "networkx", "scipy", "pyarrow", "matplotlib"]
+
+Lab = collections.namedtuple("Lab", ["db", "db_id", "formula"])
+Record = collections.namedtuple("Record", ["lab", "hg"])
+
+
+class StubDatabase:
+    # Stand-in for moldb.MoleculeDatabaseAggregator with the same lookups,
+    # so no SwissLipids/LipidMaps download is needed
+    def __init__(self, masses, records, tolerance=20):
+        order = np.argsort(masses, kind="stable")
+        self.masses = np.asarray(masses, dtype=float)[order]
+        self.data = np.empty(len(records), dtype=object)
+        self.data[:] = [records[i] for i in order]
+        self.tolerance = tolerance
+
+    def lookup(self, mass, tolerance=None):
+        tolerance = (tolerance or self.tolerance) * 1e-6
+        start = np.searchsorted(self.masses, mass * (1 - tolerance), side="left")
+        stop = np.searchsorted(self.masses, mass * (1 + tolerance), side="right")
+        return self.masses[start:stop], self.data[start:stop], None
+
+    def adduct_lookup(self, mz, ionmode="pos", adduct_constraints=True, tolerance=None):
+        from lipyd import settings
+        from lipyd import mz as mzmod
+
+        result = {}
+        for adduct, method in settings.get('ad2ex')[1][ionmode].items():
+            masses, records, _ = self.lookup(getattr(mzmod.Mz(mz), method)(), tolerance)
+            if adduct_constraints:
+                allowed = [i for i, record in enumerate(records) if lp.AdductAllowed(record, adduct, ionmode)]
+                masses, records = masses[allowed], records[allowed]
+            result[adduct] = (masses, records, None)
+        return result
+
+
+def GenerateDatabase(n_records, seed=0):
+    rng = np.random.default_rng(seed)
+    masses = rng.uniform(300, 1000, n_records)
+
+    # Every fourth record comes from LipidMaps and is skipped by the annotation
+    records = [Record(Lab("LipidMaps" if i % 4 == 3 else "SwissLipids",
+                          "LM%09d" % i if i % 4 == 3 else "SLM:%09d" % i,
+                          "C%dH%dNO8P" % (20 + i % 30, 40 + i % 60)), None)
+               for i in range(n_records)]
+    return StubDatabase(masses, records)
+
+
+def GenerateHierarchy(swl_ids, seed=0, ambiguous=0.05, orphans=0.05):
+    # Every ID points to one parent on the level above. A share ("ambiguous")
+    # of the molecular subspecies points to a second species (status "more"),
+    # another share ("orphans") to a class instead of a species (status "none")
+    rng = np.random.default_rng(seed)
+    swl_ids = rng.permutation(np.asarray(swl_ids, dtype=object))
+
+    bounds = np.cumsum([0] + [int(round(share * len(swl_ids))) for _, share in HIERARCHY_LEVELS])
+    bounds[-1] = len(swl_ids)
+    groups = [swl_ids[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    levels = pd.DataFrame({"SwissLipids_ID": np.concatenate(groups),
+                           "Level": np.repeat([level for level, _ in HIERARCHY_LEVELS],
+                                              [len(group) for group in groups])})
+
+    sources, targets = [], []
+    for depth in range(1, len(groups)):
+        children, parents = groups[depth], groups[depth - 1]
+        if len(children) == 0 or len(parents) == 0:
+            continue
+        if HIERARCHY_LEVELS[depth][0] != "Molecular subspecies":
+            sources.append(children)
+            targets.append(parents[rng.integers(0, len(parents), len(children))])
+            continue
+
+        share = rng.random(len(children))
+        orphan, linked = children[share < orphans], children[share >= orphans]
+        classes = groups[depth - 2]
+        sources.extend([orphan, linked])
+        targets.extend([classes[rng.integers(0, len(classes), len(orphan))],
+                        parents[rng.integers(0, len(parents), len(linked))]])
+
+        twice = linked[rng.random(len(linked)) < ambiguous]
+        sources.append(twice)
+        targets.append(parents[rng.integers(0, len(parents), len(twice))])
+
+    edges = pd.DataFrame({"Source": np.concatenate(sources), "Target": np.concatenate(targets)})
+    return levels, edges.drop_duplicates()
+
+
+def GenerateChebi(levels, edges, seed=0):
+    # Half of the SwissLipids IDs have a ChEBI ID, the acyclic graph follows
+    # the hierarchy between them
+    rng = np.random.default_rng(seed)
+    mapped = levels[rng.random(len(levels)) < 0.5]
+    chebi = pd.DataFrame({"ChEBI_ID": ["CHEBI:%d" % i for i in range(len(mapped))],
+                          "SwissLipids_ID": mapped.SwissLipids_ID.values})
+
+    to_chebi = chebi.set_index("SwissLipids_ID").ChEBI_ID
+    edges = edges[edges.Source.isin(to_chebi.index) & edges.Target.isin(to_chebi.index)]
+    acyclic = pd.DataFrame({"ChEBI_ID": to_chebi.loc[edges.Source].values,
+                            "Parental_ChEBI_ID": to_chebi.loc[edges.Target].values,
+                            "Parent": edges.Target.values})
+    acyclic = pd.merge(acyclic, levels.rename(columns={"SwissLipids_ID": "Parent"}), how="left")
+    return chebi, acyclic
+
+
+def GenerateFeatures(n_features, db, seed=0, noise=2.0):
+    # Features are ions of random SwissLipids records (with a few ppm of
+    # noise), a tenth of them are not in the database at all
+    rng = np.random.default_rng(seed)
+    swl = np.flatnonzero([record.lab.db == "SwissLipids" for record in db.data])
+    masses = db.masses[swl[rng.integers(0, len(swl), n_features)]]
+    unknown = rng.random(n_features) < 0.1
+    masses[unknown] = rng.uniform(300, 1000, unknown.sum())
+
+    modes = rng.choice(["pos", "neg"], n_features)
+    mz = np.empty(n_features)
+    declared = np.empty(n_features, dtype=object)
+    for mode in ["pos", "neg"]:
+        names, slopes, intercepts = lp.GetAdductConversions(mode)
+        selected = np.flatnonzero(modes == mode)
+        codes = rng.integers(0, len(names), len(selected))
+        mz[selected] = (masses[selected] - intercepts[codes]) / slopes[codes]
+        declared[selected] = [DeclaredAdduct(names[code]) for code in codes]
+
+    mz *= 1 + rng.normal(0, noise * 1e-6, n_features)
+    return pd.DataFrame({"Lipid_ID": ["FT%d" % i for i in range(n_features)],
+                         "MZ": mz,
+                         "Mode": modes,
+                         "Adduct": declared,
+                         "RT": rng.uniform(0.5, 20, n_features)})
+
+
+def DeclaredAdduct(adduct):
+    # "[M+H]+" -> "M+H", the form found in the feature tables
+    match = re.match(r"\[(.*)\]", adduct)
+    return match.group(1) if match else adduct
+
+
+def WriteReferenceFiles(workdir, levels, edges, chebi, acyclic):
+    # Same layout as the data/ directory the pipeline reads
+    data_dir = os.path.join(workdir, "data")
+    os.makedirs(data_dir, exist_ok=True)
+
+    levels.to_csv(os.path.join(data_dir, "levels_data.csv"), index=False)
+    chebi.to_csv(os.path.join(data_dir, "lipidmaps_to_chebi_to_pubchem_to_swisslipids.csv"), index=False)
+    acyclic.to_csv(os.path.join(data_dir, "acyclic_graph.csv"), index=False)
+
+    nodes = pd.unique(np.concatenate([edges.Source.values, edges.Target.values]))
+    with open(os.path.join(data_dir, "graph.txt"), "w") as f:
+        f.write("%d %d\n" % (len(nodes), len(edges)))
+        for source, target in zip(edges.Source, edges.Target):
+            f.write("%s %s\n" % (source, target))
+
+
+'''
+    Running the stages
+'''
+
+
+def RunBenchmarks(sizes=None, n_records=50000, seed=0, loop_limit=1000, workdir=None):
+    if sizes is None:
+        sizes = DEFAULT_SIZES
+
+    db = GenerateDatabase(n_records, seed=seed)
+    swl_ids = [record.lab.db_id for record in db.data if record.lab.db == "SwissLipids"]
+
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix="lipid_benchmark_")
+
+    # Without ambiguous subspecies no ID has more species, so the
+    # representatives of the IDs without a species are used
+    for name, ambiguous in [("mixed", 0.05), ("unambiguous", 0.0)]:
+        levels, edges = GenerateHierarchy(swl_ids, seed=seed, ambiguous=ambiguous)
+        chebi, acyclic = GenerateChebi(levels, edges, seed=seed)
+        WriteReferenceFiles(os.path.join(workdir, name), levels, edges, chebi, acyclic)
+
+    cwd = os.getcwd()
+    try:
+        results = []
+        record, indexes = MeasureStage("build_index",
+                                       lambda: {mode: lp.BuildAdductIndex(db, mode) for mode in ["pos", "neg"]})
+        results.append(GetResult(record, n_records, n_records, None))
+
+        for size in sizes:
+            print("...Benchmarking %d features..." % size)
+            features = GenerateFeatures(size, db, seed=seed)
+            os.chdir(os.path.join(workdir, "mixed"))
+            annotation = RunSizeBenchmarks(features, db, indexes, size, loop_limit, results)
+            os.chdir(os.path.join(workdir, "unambiguous"))
+            RunNoSpeciesBenchmarks(annotation, size, loop_limit, results)
+    finally:
+        os.chdir(cwd)
+
+    return results
+
+
+def MeasureStage(stage, function):
+    # tracemalloc slows Python loops down much more than NumPy code, so the
+    # stage is timed untraced and its peak memory comes from a second run
+    profiling.EnableProfiling(memory=False)
+    try:
+        with profiling.Stage(stage) as record:
+            output = function()
+        profiling.EnableProfiling(memory=True)
+        with profiling.Stage(stage) as traced:
+            function()
+    finally:
+        profiling.DisableProfiling()
+
+    record["peak_memory"] = traced["peak_memory"]
+    return record, output
+
+
+def RunStage(results, stage, size, function, rows_in, reference=None):
+    # "reference" is the output of the vectorized stage the output of a
+    # per-feature implementation has to match. The per-feature implementations
+    # are the original ones, which need pandas < 2 (DataFrame.append, float()
+    # of a one-row Series), so they are skipped on a newer pandas
+    try:
+        record, output = MeasureStage(stage, function)
+    except (TypeError, AttributeError) as error:
+        if reference is None:
+            raise
+        print("...Skipping %s: the reference implementation does not run with pandas %s (%s)..."
+              % (stage, pd.__version__, error))
+        return None
+
+    result = GetResult(record, size, rows_in, output)
+    if reference is not None:
+        result["matches_reference"] = result["digest"] == GetDigest(reference)
+    results.append(result)
+    return output
+
+
+def RunSizeBenchmarks(features, db, indexes, size, loop_limit, results):
+    data = features[["Lipid_ID", "MZ", "Mode"]]
+    adducts = features[["Lipid_ID", "Adduct"]]
+    positive_data, negative_data = lp.SeparatePosNegModes(data)
+
+    def Run(stage, function, rows_in, reference=None):
+        return RunStage(results, stage, size, function, rows_in, reference)
+
+    annotation = Run("annotation_batch",
+                     lambda: pd.concat([lp.GetAnnotationBatch(positive_data, indexes["pos"], adducts=adducts),
+                                        lp.GetAnnotationBatch(negative_data, indexes["neg"], adducts=adducts)]),
+                     len(data))
+
+    if size <= loop_limit:
+        Run("annotation_loop",
+            lambda: pd.concat([lp.GetAnnotation(positive_data, db, "pos", adducts=adducts),
+                               lp.GetAnnotation(negative_data, db, "neg", adducts=adducts)]),
+            len(data), reference=annotation)
+
+    levels = lp.GetReferenceTable("levels")
+    swl_ids = lp.AddingLevelsToData(annotation, levels)
+    for backend in ["networkx", "csr"]:
+        repr_to_swl = Run("representatives_%s" % backend,
+                          lambda: lp.GetRepresentatives(annotation, backend=backend, memo_dir=None),
+                          len(swl_ids))
+
+    if len(swl_ids) <= loop_limit:
+        graph = lp.CreateAnnotatedGraph(levels)
+        resolved = lp.ResolveRepresentatives(swl_ids, lp.CompileSpeciesSummary(graph))[0]
+        Run("run_dfs", lambda: lp.RunDFS(swl_ids, graph)[0], len(swl_ids), reference=resolved)
+
+    representatives = Run("selection", lambda: lp.SelectRepresentatives(annotation, repr_to_swl),
+                          len(annotation))
+    back_mapped = Run("back_mapping", lambda: lp.RepresentativesToLipids(representatives, repr_to_swl),
+                      len(representatives))
+
+    mapped = lp.AddingLevelsToAnnotatedData(back_mapped.assign(Depth=0,
+                                                               Initial_SwissLipids_ID=back_mapped.SwissLipids_ID))
+    inherited = Run("inheriting_reactions", lambda: lp.InheritingReactions(mapped), len(mapped))
+    if len(mapped) <= loop_limit:
+        Run("inheriting_reactions_iterative",
+            lambda: lp.InheritingReactionsIterative(mapped, lp.GetReferenceTable("acyclic")), len(mapped),
+            reference=inherited)
+
+    return annotation
+
+
+def RunNoSpeciesBenchmarks(annotation, size, loop_limit, results):
+    # Same annotation on the unambiguous hierarchy
+    def Run(stage, function, rows_in, reference=None):
+        return RunStage(results, stage, size, function, rows_in, reference)
+
+    levels = lp.GetReferenceTable("levels")
+    swl_ids = lp.AddingLevelsToData(annotation, levels)
+    for backend in ["networkx", "csr"]:
+        Run("representatives_no_species_%s" % backend,
+            lambda: lp.GetRepresentatives(annotation, backend=backend, memo_dir=None), len(swl_ids))
+
+    graph = lp.CreateAnnotatedGraph(levels)
+    _, more_species, no_species, _ = lp.ResolveRepresentatives(swl_ids, lp.CompileSpeciesSummary(graph))
+    if len(more_species) > 0:
+        raise ValueError("%d SwissLipids IDs have more species in the unambiguous hierarchy" % len(more_species))
+
+    batch = Run("no_species_batch", lambda: lp.GetRepresentativesNoSpeciesBatch(no_species, graph, levels),
+                len(no_species))
+    if len(no_species) <= loop_limit:
+        Run("no_species_loop", lambda: lp.GetRepresentativesNoSpecies(no_species, graph, levels),
+            len(no_species), reference=batch)
+
+
+def CheckReferences(results):
+    return ["%s (%d features): output differs from the vectorized stage" % (result["stage"], result["size"])
+            for result in results if result.get("matches_reference") is False]
+
+
+def GetResult(record, size, rows_in, output):
+    return {"stage": record["stage"],
+            "size": size,
+            "wall_time": record["wall_time"],
+            "peak_memory": record["peak_memory"],
+            "rows_in": rows_in,
+            "rows_out": None if output is None else len(output),
+            "throughput": rows_in / record["wall_time"] if record["wall_time"] > 0 else None,
+            "counters": record["counters"],
+            "digest": None if output is None else GetDigest(output)}
+
+
+def GetDigest(table):
+    # Row order and dtypes do not matter, only the content of the table
+    table = table.astype(str)
+    table = table[sorted(table.columns)]
+    table = table.sort_values(list(table.columns)).reset_index(drop=True)
+    return hashlib.sha1(table.to_csv(index=False).encode()).hexdigest()
+
+
+'''
+    Import times: every submodule of lipid_preprocessing is imported in a
+    fresh interpreter, to check that the light stages do not pay for lipyd,
+    networkx or the annotation code
+'''
+
+IMPORT_TIME_CODE = '''
+import sys, json, time
+started = time.perf_counter()
+import %s
+print(json.dumps({"time": time.perf_counter() - started,
+                  "loaded": [module for module in %r if module in sys.modules]}))
+'''
+
+
+def MeasureImportTimes(modules=None, repeats=5):
+    if modules is None:
+        modules = ["lipid_preprocessing"] + ["lipid_preprocessing." + name for name in lp._SUBMODULE_NAMES]
+
+    # The subprocesses get the module search path of this process
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path or os.getcwd() for path in sys.path))
+    results = []
+    for module in modules:
+        times = []
+        for _ in range(repeats):
+            output = subprocess.run([sys.executable, "-c", IMPORT_TIME_CODE % (module, HEAVY_MODULES)],
+                                    env=env, check=True, capture_output=True, text=True).stdout
+            measurement = json.loads(output.strip().splitlines()[-1])
+            times.append(measurement["time"])
+        results.append({"module": module,
+                        "import_time": min(times),
+                        "loaded": measurement["loaded"]})
+    return results
+
+
+def PrintImportTimes(results):
+    print("%-36s %10s  %s" % ("module", "time, ms", "heavy dependencies"))
+    for result in results:
+        print("%-36s %10.1f  %s" % (result["module"], result["import_time"] * 1000,
+                                    ", ".join(result["loaded"]) or "-"))
+
+
+'''
+    Baseline comparison
+'''
+
+
+def CompareWithBaseline(results, baseline, threshold=0.25):
+    # A stage regresses when it is slower than the baseline by more than
+    # "threshold", or when its output changed
+    previous = {(result["stage"], result["size"]): result for result in baseline["results"]}
+    regressions = []
+
+    for result in results:
+        base = previous.get((result["stage"], result["size"]))
+        if base is None:
+            continue
+        ratio = result["wall_time"] / base["wall_time"] if base["wall_time"] > 0 else 1.0
+        result["baseline_ratio"] = ratio
+        if ratio > 1 + threshold:
+            regressions.append("%s (%d features): %.2fx slower" % (result["stage"], result["size"], ratio))
+        if result["digest"] != base["digest"]:
+            regressions.append("%s (%d features): output changed" % (result["stage"], result["size"]))
+
+    return regressions
+
+
+def PrintResults(results):
+    print("%-36s %10s %10s %12s %14s %10s" % ("stage", "features", "time, s", "memory, MB",
+                                              "rows/s", "baseline"))
+    for result in results:
+        ratio = result.get("baseline_ratio")
+        print("%-36s %10d %10.3f %12.1f %14.0f %10s" % (result["stage"], result["size"], result["wall_time"],
+                                                       (result["peak_memory"] or 0) / 2.0 ** 20,
+                                                       result["throughput"] or 0,
+                                                       "-" if ratio is None else "%.2fx" % ratio))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the lipid annotation pipeline")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="Numbers of features, up to 1000000")
+    parser.add_argument("--records", type=int, default=50000,
+                        help="Number of records of the stub database")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--loop-limit", type=int, default=1000,
+                        help="Largest input of the per-feature reference implementations")
+    parser.add_argument("--workdir", default=None,
+                        help="Directory for the synthetic reference files, a temporary one by default")
+    parser.add_argument("--output", default=None, help="Write the results to JSON")
+    parser.add_argument("--baseline", default=None, help="Compare against a saved baseline")
+    parser.add_argument("--save-baseline", default=None, help="Save the results as a baseline")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="Allowed slowdown against the baseline")
+    parser.add_argument("--import-times", action="store_true",
+                        help="Only measure the import time of every submodule")
+    args = parser.parse_args()
+
+    if args.import_times:
+        import_times = MeasureImportTimes()
+        PrintImportTimes(import_times)
+        if args.output is not None:
+            os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+            with open(args.output, "w") as f:
+                json.dump({"version": BENCHMARK_VERSION, "import_times": import_times}, f, indent=2)
+        sys.exit(0)
+
+    results = RunBenchmarks(sizes=args.sizes, n_records=args.records, seed=args.seed,
+                            loop_limit=args.loop_limit, workdir=args.workdir)
+
+    regressions = CheckReferences(results)
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            regressions += CompareWithBaseline(results, json.load(f), threshold=args.threshold)
+
+    PrintResults(results)
+
+    report = {"version": BENCHMARK_VERSION,
+              "config": {"records": args.records, "seed": args.seed, "loop_limit": args.loop_limit},
+              "results": results}
+    for path in [args.output, args.save_baseline]:
+        if path is not None:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+
+    if regressions:
+        print("Regressions:")
+        for regression in regressions:
+            print("  " + regression)
+        sys.exit(1)
@@ -0,0 +1,79 @@
+import importlib
+
+
+'''
+    Lipid preprocessing is split into stage submodules which are imported on
+    first use: "lp.GetReferenceTable" only loads the reference registry, while
+    lipyd and networkx are not imported until a stage needs them
+
+    storage            cache directories, checksums and table formats
+    reference          registry of the SwissLipids and ChEBI reference tables
+    curation           checking and normalization of the lipyd annotation
+    mapping            back mapping to the lipids, ChEBI levels and sparse output
+    annotation         lipyd annotation, adduct indexes and feature grouping
+    representatives    SwissLipids graph, summaries and representatives
+    incremental        annotation and representatives of the new features only
+    propagation        aggregation of feature values up the ChEBI hierarchy
+'''
+
+_SUBMODULE_NAMES = {
+    "storage": ["GetChecksums", "GetChecksum", "CommitCacheDirectory", "WriteTableChunks", "GetChunkSchema",
+                "ID_COLUMNS", "GetDefaultTableFormat", "GetTableFormat", "WriteTable", "ReadTable",
+                "FileLock", "LOCK_TIMEOUT"],
+    "reference": ["REFERENCE_DIR", "REFERENCE_TABLES", "GetReferenceTable", "GetReferenceKey",
+                  "LoadReferenceTable"],
+    "curation": ["CheckAnnotation", "GetRepresentativesClasses", "ANNOTATION_PATTERN",
+                 "ANNOTATION_BRACKETS", "CheckAnnotationBatch", "GetNormalizedAnnotations",
+                 "NormalizeAnnotations", "NormalizeAnnotation"],
+    "mapping": ["RepresentativesToLipids", "MappingToGraph", "INHERITANCE_COLUMNS",
+                "PARENT_COLUMNS", "InheritingReactions", "CompileAncestorClosure",
+                "GetClosureLevel", "InheritingReactionsIterative", "GetParents",
+                "AddingLevelsToAnnotatedData", "MATRIX_DTYPE", "BuildIncidenceMatrix",
+                "WriteIncidenceMatrix", "ReadIncidenceMatrix", "GetSmallestDepths"],
+    "annotation": ["SWISSLIPIDS_LEVELS", "AnnotateDataWithLipyd", "ComposeDatabase",
+                   "ADDUCT_INDEX_CACHE_VERSION", "ADDUCT_INDEX_ARRAYS", "LoadAdductIndexes",
+                   "GetDatabaseFiles", "DATABASE_FILE_PATTERNS", "GetAdductIndexKey", "WriteAdductIndexes",
+                   "ReadAdductIndex",
+                   "SeparatePosNegModes", "GetAnnotation", "AddAdducts", "BuildAdductIndex",
+                   "GetAdductConversions", "AdductAllowed", "MatchFeatures",
+                   "MatchFeaturesWithAdducts", "MatchAdduct", "GetTolerance", "EmptyMatches",
+                   "RankMatches", "GetAnnotationBatch", "GetAnnotationParallel", "GetWorkerCount",
+                   "InitAnnotationWorker", "AnnotateChunk", "ANNOTATION_DTYPES", "SCORE_DTYPES",
+                   "AnnotateDataWithLipydStreaming", "IterAnnotatedChunks",
+                   "AnnotateGroupedFeatures", "GroupFeatures", "FanOutAnnotation", "GetMemberErrors",
+                   "ConfirmLinkedCandidates"],
+    "representatives": ["GetRepresentatives", "CompileReferenceState", "SelectRepresentatives",
+                        "GetRepresentativesNoSpecies", "GetRepresentativesNoSpeciesBatch",
+                        "GetLevelSeeds", "GetParentsWithLevels", "RunDFS", "CompileSpeciesSummary",
+                        "GetSpeciesSeeds", "CompileReachableSummary", "MergeReachableSummary",
+                        "ResolveRepresentatives", "CreateAnnotatedGraph", "AddingLevelsToData",
+                        "AnnotateGraph", "MakeGraph", "ReadFile", "ReadList", "GetData", "CSRGraph",
+                        "CSRNodeView", "CreateAnnotatedCSRGraph", "GetDataArrays", "MakeCSRGraph",
+                        "GetCSRLevels", "DFSPreorder", "CompileCSRReachableSummary",
+                        "GRAPH_SNAPSHOT_VERSION", "GRAPH_SNAPSHOT_ARRAYS", "LoadGraphSnapshot",
+                        "GetGraphSnapshotKey", "CompileGraphSnapshot", "ReadGraphSnapshot",
+                        "REPRESENTATIVES_MEMO_COLUMNS", "LoadRepresentativesMemo",
+                        "SaveRepresentativesMemo", "GetRepresentativesMemoPath"],
+    "incremental": ["INCREMENTAL_STORE_VERSION", "FEATURE_KEY",
+                    "AnnotateDataIncremental", "GetRepresentativesIncremental", "GetFeatureKeys",
+                    "GetFeatureSignatures",
+                    "GetIncrementalStoreKey", "ReadIncrementalStore", "WriteIncrementalStore"],
+    "propagation": ["AGGREGATIONS", "MAX_BLOCK_SIZE", "GetOntologyOperator", "CompileOntologyOperator",
+                    "PropagateToOntology", "GetReachedNodes", "GetColumnMaxima", "WritePropagatedValues"]}
+
+_SUBMODULES = {name: submodule for submodule, names in _SUBMODULE_NAMES.items() for name in names}
+
+
+def __getattr__(name):
+    if name in _SUBMODULE_NAMES:
+        return importlib.import_module("." + name, __name__)
+    if name not in _SUBMODULES:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+    value = getattr(importlib.import_module("." + _SUBMODULES[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_SUBMODULE_NAMES) | set(_SUBMODULES))
@@ -0,0 +1,743 @@
+import pandas as pd
+import numpy as np
+import os
+import json
+import hashlib
+import multiprocessing
+import profiling
+from .storage import CommitCacheDirectory, GetChecksums, WriteTableChunks
+
+
+''' 
+    This part is dedicated to creating the annotation of the data via lipyd
+'''
+
+
+SWISSLIPIDS_LEVELS = {'Species', 'Isomeric subspecies',
+                      'Molecular subspecies',
+                      'Structural subspecies'}
+
+
+@profiling.Profiled("annotation")
+def AnnotateDataWithLipyd(data, adducts=None, batch=True, levels=None,
+                          cache_dir="cache/lipyd", db_files=None, n_jobs=1, chunk_size=None,
+                          tolerance=None, max_error=None, top_k=None, scores=False):
+    positive_data, negative_data = SeparatePosNegModes(data)
+
+    # Tolerance (ppm), pruning and ranking of the candidates of the batch annotation
+    options = {"tolerance": tolerance, "max_error": max_error, "top_k": top_k, "scores": scores}
+
+    n_jobs = GetWorkerCount(n_jobs)
+    if batch and n_jobs != 1:
+        indexes = LoadAdductIndexes(levels=levels, cache_dir=cache_dir, db_files=db_files)
+
+        print("...Annotating positive and negative lipids in parallel...")
+        positive_data, negative_data = GetAnnotationParallel(positive_data, negative_data,
+                                                             indexes=indexes, adducts=adducts,
+                                                             n_jobs=n_jobs, chunk_size=chunk_size,
+                                                             options=options)
+
+    elif batch:
+        indexes = LoadAdductIndexes(levels=levels, cache_dir=cache_dir, db_files=db_files)
+
+        print("...Annotating positive lipids...")
+        positive_data = GetAnnotationBatch(positive_data, index=indexes['pos'], adducts=adducts, **options)
+
+        print("...Annotating negative lipids...")
+        negative_data = GetAnnotationBatch(negative_data, index=indexes['neg'], adducts=adducts, **options)
+
+    else:
+        db = ComposeDatabase(levels)
+
+        print("...Annotating positive lipids...")
+        positive_data = GetAnnotation(positive_data, db=db, mode='pos', adducts=adducts)
+
+        print("...Annotating negative lipids...")
+        negative_data = GetAnnotation(negative_data, db=db, mode='neg', adducts=adducts)
+
+    annotated_data = pd.concat([positive_data, negative_data])
+
+    return annotated_data
+
+
+def ComposeDatabase(levels=None):
+    from lipyd import moldb
+
+    if levels is None:
+        levels = SWISSLIPIDS_LEVELS
+
+    print("...Composing MoleculeDatabaseAggregator....")
+    db = moldb.MoleculeDatabaseAggregator(resources={
+        'SwissLipids': (moldb.SwissLipids, {'levels': set(levels)}),
+        'LipidMaps': (moldb.LipidMaps, {})
+    })
+    return db
+
+
+'''
+    Persistent cache of the adduct indexes: the flattened SwissLipids records
+    and their theoretical m/z are stored as .npy files and memory-mapped back,
+    keyed by the checksums of the database files and the requested levels
+'''
+
+ADDUCT_INDEX_CACHE_VERSION = 2
+
+# Names of the files ComposeDatabase reads, matched case-insensitively
+DATABASE_FILE_PATTERNS = ["swisslipids", "lipidmaps", "lmsd"]
+ADDUCT_INDEX_ARRAYS = ["slopes", "intercepts", "mz", "adduct", "record",
+                       "adduct_mz", "adduct_record", "adduct_offsets",
+                       "mass", "position", "swl_ids", "formulas"]
+
+
+def LoadAdductIndexes(levels=None, cache_dir="cache/lipyd", db_files=None, tolerance=None):
+    if levels is None:
+        levels = SWISSLIPIDS_LEVELS
+
+    if cache_dir is None:
+        db = ComposeDatabase(levels)
+        return {mode: BuildAdductIndex(db, mode=mode, tolerance=tolerance) for mode in ['pos', 'neg']}
+
+    if db_files is None:
+        db_files = GetDatabaseFiles()
+
+    if len(db_files) > 0:
+        key = GetAdductIndexKey(levels, db_files, tolerance)
+        path = os.path.join(cache_dir, key)
+        if os.path.exists(os.path.join(path, "meta.json")):
+            print("...Loading cached adduct indexes...")
+            return {mode: ReadAdductIndex(path, mode) for mode in ['pos', 'neg']}
+
+    db = ComposeDatabase(levels)
+    indexes = {mode: BuildAdductIndex(db, mode=mode, tolerance=tolerance) for mode in ['pos', 'neg']}
+
+    # On the first run the databases are only downloaded by ComposeDatabase
+    if len(db_files) == 0:
+        db_files = GetDatabaseFiles()
+        if len(db_files) == 0:
+            return indexes
+        key = GetAdductIndexKey(levels, db_files, tolerance)
+        path = os.path.join(cache_dir, key)
+
+    print("...Saving adduct indexes to cache...")
+    WriteAdductIndexes(indexes, path, meta={"version": ADDUCT_INDEX_CACHE_VERSION,
+                                            "levels": sorted(levels),
+                                            "db_files": GetChecksums(db_files),
+                                            "tolerance": tolerance})
+    return indexes
+
+
+def GetDatabaseFiles(download=False):
+    from lipyd import settings
+
+    # SwissLipids and LipidMaps downloads (and the LipidMaps SDF extracted
+    # from them) in the lipyd cache directory, every file of it if none of
+    # them is recognized. "download" fetches the databases on the first run
+    cachedir = settings.get('cachedir') or "cache"
+    files = []
+    if os.path.isdir(cachedir):
+        for root, _, names in os.walk(cachedir):
+            files.extend(os.path.join(root, name) for name in names)
+    files = sorted(files)
+
+    databases = [f for f in files if any(pattern in os.path.basename(f).lower()
+                                         for pattern in DATABASE_FILE_PATTERNS)]
+    if len(databases) == 0:
+        databases = [f for f in files if os.path.dirname(f) == cachedir]
+
+    if len(databases) == 0 and download:
+        LoadAdductIndexes()
+        return GetDatabaseFiles()
+    return databases
+
+
+def GetAdductIndexKey(levels, db_files, tolerance=None):
+    key = json.dumps({"version": ADDUCT_INDEX_CACHE_VERSION,
+                      "levels": sorted(levels),
+                      "db_files": GetChecksums(db_files),
+                      "tolerance": tolerance}, sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def WriteAdductIndexes(indexes, path, meta):
+    # Writing to a temporary directory first, so concurrent runs never see
+    # a half-written cache
+    tmp_path = "%s.tmp%d" % (path, os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+
+    for mode, index in indexes.items():
+        for array in ADDUCT_INDEX_ARRAYS:
+            values = index[array]
+            if values.dtype == object:
+                values = values.astype(str)
+            np.save(os.path.join(tmp_path, "%s_%s.npy" % (mode, array)), values)
+        meta[mode] = {"adducts": index["adducts"], "tolerance": index["tolerance"]}
+
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+    CommitCacheDirectory(tmp_path, path)
+
+
+def ReadAdductIndex(path, mode):
+    with open(os.path.join(path, "meta.json"), "r") as f:
+        meta = json.load(f)
+
+    index = {"mode": mode,
+             "tolerance": meta[mode]["tolerance"],
+             "adducts": meta[mode]["adducts"]}
+    for array in ADDUCT_INDEX_ARRAYS:
+        index[array] = np.load(os.path.join(path, "%s_%s.npy" % (mode, array)), mmap_mode="r")
+    return index
+
+
+'''
+    This part is dedicated to annotating features
+'''
+
+
+def SeparatePosNegModes(data):
+    positive_data = data[data.Mode == "pos"]
+    negative_data = data[data.Mode == "neg"]
+
+    positive_data = positive_data.reset_index(drop=True)
+    negative_data = negative_data.reset_index(drop=True)
+
+    positive_data = positive_data[["Lipid_ID", "MZ"]]
+    negative_data = negative_data[["Lipid_ID", "MZ"]]
+
+    return positive_data, negative_data
+
+
+@profiling.Profiled("annotation_loop")
+def GetAnnotation(pos_neg_data, db, mode, adducts=None):
+
+    if adducts is not None:
+        pos_neg_data = AddAdducts(pos_neg_data, adducts)
+    annotation = pd.DataFrame(columns=["Lipid_ID", "SwissLipids_ID",
+                                       "Formula",
+                                       "Modification", "MZ"])
+
+    for lipid_id in pos_neg_data.Lipid_ID:
+        mass = float(pos_neg_data[pos_neg_data.Lipid_ID == lipid_id].MZ)
+        result = db.adduct_lookup(mass, ionmode=mode)
+        profiling.Count("db_lookups")
+
+        for modification in result.keys():
+            r = result[modification]
+
+            for Lipid_Record in r[1]:
+                if adducts is not None:
+                    # Checking adduct
+                    tmp = pos_neg_data[pos_neg_data.Lipid_ID == lipid_id]
+                    tmp = tmp.reset_index(drop=True)
+
+                    if str(tmp.Adduct.iloc[0]) in modification:
+                        if Lipid_Record.lab.db == "SwissLipids":
+                            annotation = annotation.append({"Lipid_ID": lipid_id,
+                                                            "SwissLipids_ID": Lipid_Record.lab.db_id,
+                                                            "Formula": Lipid_Record.lab.formula,
+                                                            "Modification": modification,
+                                                            "MZ": mass},
+                                                           ignore_index=True)
+                else:
+                    if Lipid_Record.lab.db == "SwissLipids":
+                        annotation = annotation.append({"Lipid_ID": lipid_id,
+                                                        "SwissLipids_ID": Lipid_Record.lab.db_id,
+                                                        "Formula": Lipid_Record.lab.formula,
+                                                        "Modification": modification,
+                                                        "MZ": mass},
+                                                       ignore_index=True)
+
+    return annotation
+
+
+def AddAdducts(data, adducts):
+    data = pd.merge(data, adducts, how="left")
+    return data
+
+
+'''
+    Batch annotation: every SwissLipids record of the database is ionized once
+    for every adduct of the mode, and all features are matched against
+    the sorted theoretical m/z values at once
+'''
+
+
+def BuildAdductIndex(db, mode, tolerance=None):
+    if tolerance is None:
+        tolerance = db.tolerance
+
+    swl = np.array([record.lab.db == "SwissLipids" for record in db.data], dtype=bool)
+    positions = np.flatnonzero(swl)
+    records = db.data[positions]
+    masses = np.asarray(db.masses, dtype=float)[positions]
+
+    adduct_names, slopes, intercepts = GetAdductConversions(mode)
+
+    mz_values = []
+    adduct_codes = []
+    record_codes = []
+    for code, adduct in enumerate(adduct_names):
+        allowed = np.array([AdductAllowed(record, adduct, mode) for record in records], dtype=bool)
+        allowed = np.flatnonzero(allowed)
+        # Inverse of the adduct removal: exact mass -> theoretical m/z
+        mz_values.append((masses[allowed] - intercepts[code]) / slopes[code])
+        adduct_codes.append(np.full(len(allowed), code, dtype=np.int16))
+        record_codes.append(allowed.astype(np.int64))
+
+    mz_values = np.concatenate(mz_values) if mz_values else np.empty(0)
+    adduct_codes = np.concatenate(adduct_codes) if adduct_codes else np.empty(0, dtype=np.int16)
+    record_codes = np.concatenate(record_codes) if record_codes else np.empty(0, dtype=np.int64)
+
+    order = np.argsort(mz_values, kind="stable")
+
+    # One sorted m/z segment per adduct, for adduct-constrained lookups
+    by_adduct = np.lexsort((mz_values, adduct_codes))
+    adduct_offsets = np.zeros(len(adduct_names) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(adduct_codes, minlength=len(adduct_names)), out=adduct_offsets[1:])
+
+    index = {"mode": mode,
+             "tolerance": float(tolerance),
+             "adducts": list(adduct_names),
+             "slopes": slopes,
+             "intercepts": intercepts,
+             "mz": mz_values[order],
+             "adduct": adduct_codes[order],
+             "record": record_codes[order],
+             "adduct_mz": mz_values[by_adduct],
+             "adduct_record": record_codes[by_adduct],
+             "adduct_offsets": adduct_offsets,
+             "mass": masses,
+             "position": positions,
+             "swl_ids": np.array([record.lab.db_id for record in records], dtype=object),
+             "formulas": np.array([record.lab.formula for record in records], dtype=object)}
+    return index
+
+
+def GetAdductConversions(mode):
+    from lipyd import settings
+    from lipyd import mz as mzmod
+
+    # Adduct removal in lipyd is linear in m/z, so it is sampled at two points
+    # to get the slope and the intercept for every adduct of the mode
+    adducts = settings.get('ad2ex')[1][mode]
+    adduct_names = list(adducts.keys())
+    slopes = np.empty(len(adduct_names))
+    intercepts = np.empty(len(adduct_names))
+
+    for i, adduct in enumerate(adduct_names):
+        low = getattr(mzmod.Mz(100.0), adducts[adduct])()
+        high = getattr(mzmod.Mz(1000.0), adducts[adduct])()
+        slopes[i] = (high - low) / 900.0
+        intercepts[i] = low - slopes[i] * 100.0
+
+    return adduct_names, slopes, intercepts
+
+
+def AdductAllowed(record, adduct, mode):
+    from lipyd import settings
+
+    # Same constraints as in db.adduct_lookup(..., adduct_constraints=True)
+    constraints = settings.get('adduct_constraints_%s' % mode)
+    hg = getattr(record, "hg", None)
+    if not constraints or hg is None or hg not in constraints:
+        return True
+    return constraints[hg] == adduct
+
+
+def MatchFeatures(mz_values, index, tolerance=None):
+    mz_values = np.asarray(mz_values, dtype=float)
+    slopes = index["slopes"]
+    intercepts = index["intercepts"]
+    tolerance = GetTolerance(index, tolerance)
+
+    if len(mz_values) == 0 or len(slopes) == 0:
+        return EmptyMatches()
+
+    # Widest m/z window over all adducts, refined per adduct below
+    exact = np.outer(mz_values, slopes) + intercepts
+    lower = ((exact * (1 - tolerance) - intercepts) / slopes).min(axis=1)
+    upper = ((exact * (1 + tolerance) - intercepts) / slopes).max(axis=1)
+
+    start = np.searchsorted(index["mz"], lower, side="left")
+    stop = np.searchsorted(index["mz"], upper, side="right")
+    counts = stop - start
+
+    feature = np.repeat(np.arange(len(mz_values)), counts)
+    entry = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(start, counts)
+
+    adduct = index["adduct"][entry].astype(np.int64)
+    record = index["record"][entry]
+
+    exact = mz_values[feature] * slopes[adduct] + intercepts[adduct]
+    mass = index["mass"][record]
+    keep = np.abs(mass - exact) <= exact * tolerance
+
+    feature, adduct, record = feature[keep], adduct[keep], record[keep]
+    error = (exact[keep] - mass[keep]) / mass[keep] * 1e6
+    profiling.Count("db_lookups", len(mz_values))
+    profiling.Count("candidates", len(feature))
+
+    # Same order as the per-feature loop: feature, adduct, database position
+    order = np.lexsort((record, adduct, feature))
+    return feature[order], adduct[order], record[order], error[order]
+
+
+def MatchFeaturesWithAdducts(mz_values, declared_adducts, index, tolerance=None):
+    mz_values = np.asarray(mz_values, dtype=float)
+    declared, declared_codes = np.unique(np.asarray(declared_adducts).astype(str), return_inverse=True)
+
+    # A declared adduct (e.g. "M+H") selects every adduct table whose name contains it
+    features, adducts, records, errors = [], [], [], []
+    for declared_code, declared_adduct in enumerate(declared):
+        selected = np.flatnonzero(declared_codes == declared_code)
+        for code, adduct in enumerate(index["adducts"]):
+            if declared_adduct not in adduct:
+                continue
+            feature, record, error = MatchAdduct(mz_values[selected], index, code, tolerance=tolerance)
+            features.append(selected[feature])
+            adducts.append(np.full(len(feature), code, dtype=np.int64))
+            records.append(record)
+            errors.append(error)
+
+    if len(features) == 0:
+        return EmptyMatches()
+
+    feature, adduct = np.concatenate(features), np.concatenate(adducts)
+    record, error = np.concatenate(records), np.concatenate(errors)
+
+    # Same order as the per-feature loop: feature, adduct, database position
+    order = np.lexsort((record, adduct, feature))
+    return feature[order], adduct[order], record[order], error[order]
+
+
+def MatchAdduct(mz_values, index, code, tolerance=None):
+    slope = index["slopes"][code]
+    intercept = index["intercepts"][code]
+    tolerance = GetTolerance(index, tolerance)
+    segment_start = index["adduct_offsets"][code]
+    segment = index["adduct_mz"][segment_start:index["adduct_offsets"][code + 1]]
+
+    exact = mz_values * slope + intercept
+    start = np.searchsorted(segment, (exact * (1 - tolerance) - intercept) / slope, side="left")
+    stop = np.searchsorted(segment, (exact * (1 + tolerance) - intercept) / slope, side="right")
+    counts = stop - start
+
+    feature = np.repeat(np.arange(len(mz_values)), counts)
+    entry = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(start, counts)
+    record = index["adduct_record"][segment_start + entry]
+
+    exact = exact[feature]
+    mass = index["mass"][record]
+    keep = np.abs(mass - exact) <= exact * tolerance
+    error = (exact[keep] - mass[keep]) / mass[keep] * 1e6
+    profiling.Count("db_lookups", len(mz_values))
+    profiling.Count("candidates", len(error))
+    return feature[keep], record[keep], error
+
+
+def GetTolerance(index, tolerance=None):
+    # ppm -> relative tolerance, the index tolerance is the default
+    if tolerance is None:
+        tolerance = index["tolerance"]
+    return tolerance * 1e-6
+
+
+def EmptyMatches():
+    empty = np.empty(0, dtype=np.int64)
+    return empty, empty, empty, np.empty(0, dtype=float)
+
+
+def RankMatches(feature, error):
+    # 1 for the candidate with the smallest absolute mass error of every feature
+    order = np.lexsort((np.abs(error), feature))
+    sorted_feature = feature[order]
+    starts = np.flatnonzero(np.r_[True, sorted_feature[1:] != sorted_feature[:-1]])
+    counts = np.diff(np.r_[starts, len(sorted_feature)])
+
+    rank = np.empty(len(feature), dtype=np.int64)
+    rank[order] = np.arange(len(feature)) - np.repeat(starts, counts) + 1
+    return rank
+
+
+@profiling.Profiled("annotation_batch")
+def GetAnnotationBatch(pos_neg_data, index, adducts=None, tolerance=None, max_error=None,
+                       top_k=None, scores=False):
+    if adducts is not None:
+        pos_neg_data = AddAdducts(pos_neg_data, adducts)
+    pos_neg_data = pos_neg_data.reset_index(drop=True)
+
+    # Pruning by mass error narrows the search window itself
+    if max_error is not None:
+        tolerance = min(max_error, index["tolerance"] if tolerance is None else tolerance)
+
+    if adducts is not None:
+        feature, adduct, record, error = MatchFeaturesWithAdducts(pos_neg_data.MZ.values,
+                                                                  pos_neg_data.Adduct.values, index,
+                                                                  tolerance=tolerance)
+    else:
+        feature, adduct, record, error = MatchFeatures(pos_neg_data.MZ.values, index, tolerance=tolerance)
+
+    if max_error is not None:
+        keep = np.abs(error) <= max_error
+        feature, adduct, record, error = feature[keep], adduct[keep], record[keep], error[keep]
+
+    rank = RankMatches(feature, error)
+    if top_k is not None:
+        keep = rank <= top_k
+        feature, adduct, record, error, rank = feature[keep], adduct[keep], record[keep], error[keep], rank[keep]
+
+    annotation = pd.DataFrame({"Lipid_ID": pos_neg_data.Lipid_ID.values[feature],
+                               "SwissLipids_ID": index["swl_ids"][record],
+                               "Formula": index["formulas"][record],
+                               "Modification": np.array(index["adducts"], dtype=object)[adduct],
+                               "MZ": pos_neg_data.MZ.values[feature].astype(float)},
+                              columns=["Lipid_ID", "SwissLipids_ID",
+                                       "Formula",
+                                       "Modification", "MZ"])
+    if scores:
+        annotation["Error_ppm"] = error
+        annotation["Rank"] = rank
+    return annotation
+
+
+'''
+    Parallel annotation: both modes are split into chunks of features which are
+    annotated by a pool of worker processes. The adduct indexes are handed over
+    through fork (copy-on-write) or the memory-mapped cache, never per chunk
+'''
+
+_ANNOTATION_WORKER = {}
+
+
+def GetAnnotationParallel(positive_data, negative_data, indexes, adducts=None, n_jobs=None, chunk_size=None,
+                          options=None):
+    if options is None:
+        options = {}
+    n_jobs = GetWorkerCount(n_jobs)
+    if chunk_size is None:
+        # A few chunks per worker keep the pool balanced
+        chunk_size = max(1, int(np.ceil((len(positive_data) + len(negative_data)) / (4.0 * n_jobs))))
+
+    data = {'pos': positive_data, 'neg': negative_data}
+    tasks = []
+    for mode, pos_neg_data in data.items():
+        for start in range(0, len(pos_neg_data), chunk_size):
+            tasks.append((mode, pos_neg_data.iloc[start:start + chunk_size]))
+
+    _ANNOTATION_WORKER["indexes"] = indexes
+    _ANNOTATION_WORKER["adducts"] = adducts
+    _ANNOTATION_WORKER["options"] = options
+
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+        initializer, initargs = None, ()
+    else:
+        context = multiprocessing.get_context()
+        initializer, initargs = InitAnnotationWorker, (indexes, adducts, options)
+
+    try:
+        with context.Pool(processes=n_jobs, initializer=initializer, initargs=initargs) as pool:
+            results = pool.map(AnnotateChunk, tasks, chunksize=1)
+    finally:
+        _ANNOTATION_WORKER.clear()
+
+    annotated_data = []
+    for mode in ['pos', 'neg']:
+        chunks = [result for (task_mode, _), result in zip(tasks, results) if task_mode == mode]
+        if len(chunks) == 0:
+            chunks = [GetAnnotationBatch(data[mode], index=indexes[mode], adducts=adducts, **options)]
+        annotated_data.append(pd.concat(chunks).reset_index(drop=True))
+
+    return annotated_data[0], annotated_data[1]
+
+
+def GetWorkerCount(n_jobs):
+    # None or n_jobs <= 0 use every CPU
+    if n_jobs is None or n_jobs <= 0:
+        return os.cpu_count() or 1
+    return n_jobs
+
+
+def InitAnnotationWorker(indexes, adducts, options):
+    _ANNOTATION_WORKER["indexes"] = indexes
+    _ANNOTATION_WORKER["adducts"] = adducts
+    _ANNOTATION_WORKER["options"] = options
+
+
+def AnnotateChunk(task):
+    mode, pos_neg_data = task
+    return GetAnnotationBatch(pos_neg_data, index=_ANNOTATION_WORKER["indexes"][mode],
+                              adducts=_ANNOTATION_WORKER["adducts"], **_ANNOTATION_WORKER["options"])
+
+
+'''
+    Streaming annotation: the feature table is read in chunks and every
+    annotated chunk is appended to the output, so memory stays bounded by the
+    chunk size. Positive and negative features are annotated in two passes
+    over the input to keep the row order of AnnotateDataWithLipyd
+'''
+
+ANNOTATION_DTYPES = {"Lipid_ID": "string",
+                     "SwissLipids_ID": "string",
+                     "Formula": "string",
+                     "Modification": "string",
+                     "MZ": "float64"}
+SCORE_DTYPES = {"Error_ppm": "float64",
+                "Rank": "int64"}
+
+
+@profiling.Profiled("annotation_streaming")
+def AnnotateDataWithLipydStreaming(read_chunks, output_file, levels=None,
+                                   cache_dir="cache/lipyd", db_files=None,
+                                   tolerance=None, max_error=None, top_k=None, scores=False):
+    # "read_chunks" should return a new iterator over pd.DataFrame chunks,
+    # formatted like this: --- Lipid_ID, MZ, Mode --- and optionally "Adduct"
+    indexes = LoadAdductIndexes(levels=levels, cache_dir=cache_dir, db_files=db_files)
+    options = {"tolerance": tolerance, "max_error": max_error, "top_k": top_k, "scores": scores}
+
+    dtypes = dict(ANNOTATION_DTYPES)
+    if scores:
+        dtypes.update(SCORE_DTYPES)
+    WriteTableChunks(IterAnnotatedChunks(read_chunks, indexes, options), output_file, dtypes)
+
+
+def IterAnnotatedChunks(read_chunks, indexes, options=None):
+    if options is None:
+        options = {}
+    for mode, name in [('pos', "positive"), ('neg', "negative")]:
+        print("...Annotating %s lipids..." % name)
+        for chunk in read_chunks():
+            chunk = chunk[chunk.Mode == mode]
+            adducts = None
+            if "Adduct" in chunk.columns:
+                adducts = chunk[["Lipid_ID", "Adduct"]]
+            yield GetAnnotationBatch(chunk[["Lipid_ID", "MZ"]], index=indexes[mode], adducts=adducts,
+                                     **options)
+
+
+'''
+    Feature grouping before annotation: features of the same mode and adduct
+    whose m/z (and RT, if given) differ by less than the tolerances are
+    annotated once through their first member, and the annotation is fanned
+    back out to every member. With link_modes, a feature linked through
+    Index_Othermode keeps only the candidates confirmed by the annotation of
+    its other-mode feature (the same SwissLipids ID), when there are any
+'''
+
+
+@profiling.Profiled("annotation_grouped")
+def AnnotateGroupedFeatures(data, adducts=None, mz_tolerance=0.0, rt_tolerance=None,
+                            link_modes=False, **kwargs):
+    # "data" is formatted like this: --- Lipid_ID, MZ, Mode ---
+    # and optionally "RT" and "Index_Othermode", the rest is passed to AnnotateDataWithLipyd
+    groups = GroupFeatures(data if adducts is None else AddAdducts(data, adducts),
+                           mz_tolerance=mz_tolerance, rt_tolerance=rt_tolerance)
+
+    representatives = data[data.Lipid_ID.isin(groups.Representative)]
+    print("...Annotating %d groups of %d features..." % (len(representatives), len(data)))
+    annotation = AnnotateDataWithLipyd(representatives[["Lipid_ID", "MZ", "Mode"]], adducts=adducts, **kwargs)
+
+    annotation = FanOutAnnotation(annotation, groups, data)
+    if link_modes and "Index_Othermode" in data.columns:
+        annotation = ConfirmLinkedCandidates(annotation, data)
+    return annotation
+
+
+def GroupFeatures(features, mz_tolerance=0.0, rt_tolerance=None):
+    features = features.reset_index(drop=True)
+    mz = features.MZ.values.astype(float)
+    bucket = features.Mode.astype(str)
+    if "Adduct" in features.columns:
+        bucket = bucket + "/" + features.Adduct.astype(str)
+    bucket = pd.factorize(bucket)[0]
+
+    # Sorted sweep over m/z inside every mode/adduct bucket: a gap larger than
+    # the tolerance (ppm) starts a new group
+    order = np.lexsort((mz, bucket))
+    gap = np.diff(mz[order]) > mz[order][:-1] * mz_tolerance * 1e-6
+    start = np.r_[True, gap | (np.diff(bucket[order]) != 0)]
+    group = np.empty(len(features), dtype=np.int64)
+    group[order] = np.cumsum(start) - 1
+
+    # Same sweep over RT inside every m/z group
+    if rt_tolerance is not None and "RT" in features.columns:
+        rt = features.RT.values.astype(float)
+        order = np.lexsort((rt, group))
+        start = np.r_[True, (np.diff(rt[order]) > rt_tolerance) | (np.diff(group[order]) != 0)]
+        group[order] = np.cumsum(start) - 1
+
+    # The first feature of every group is annotated for the whole group
+    group = pd.factorize(group)[0]
+    first = np.unique(group, return_index=True)[1]
+    representative = features.Lipid_ID.values[first][group]
+
+    return pd.DataFrame({"Lipid_ID": features.Lipid_ID.values,
+                         "Group": group,
+                         "Representative": representative})
+
+
+def FanOutAnnotation(annotation, groups, data):
+    members = groups.merge(data[["Lipid_ID", "MZ", "Mode"]], how="left")
+    members["Position"] = np.arange(len(members))
+    members["Mode_order"] = (members.Mode != "pos").astype(int)
+
+    annotation = annotation.reset_index(drop=True)
+    annotation["Candidate"] = np.arange(len(annotation))
+    annotation["Group"] = annotation.Lipid_ID.map(
+        groups.drop_duplicates("Representative").set_index("Representative").Group)
+
+    # Every member gets the candidates of its group, with its own ID and m/z
+    result = members[["Lipid_ID", "MZ", "Mode", "Group", "Position", "Mode_order"]].merge(
+        annotation.drop(columns=["Lipid_ID"]).rename(columns={"MZ": "Representative_MZ"}), on="Group")
+    result = result.sort_values(["Mode_order", "Position", "Candidate"])
+
+    if "Error_ppm" in result.columns:
+        result["Error_ppm"] = GetMemberErrors(result)
+    if "Rank" in result.columns:
+        result["Rank"] = RankMatches(result.Position.values, result.Error_ppm.values)
+
+    return result[annotation.columns.drop(["Candidate", "Group"])].reset_index(drop=True)
+
+
+def GetMemberErrors(result):
+    # The mass error of the representative is moved to the m/z of the member
+    # through the linear adduct conversion of the candidate
+    mz = result.MZ.values.astype(float)
+    representative_mz = result.Representative_MZ.values.astype(float)
+    error = result.Error_ppm.values.astype(float)
+    moved = mz != representative_mz
+    if not moved.any():
+        return error
+
+    slope = np.empty(len(result))
+    intercept = np.empty(len(result))
+    for mode in result.Mode[moved].unique():
+        names, slopes, intercepts = GetAdductConversions(mode)
+        selected = moved & (result.Mode.values == mode)
+        code = pd.Index(names).get_indexer(result.Modification.values[selected])
+        slope[selected], intercept[selected] = slopes[code], intercepts[code]
+
+    mass = (representative_mz * slope + intercept) / (1 + error * 1e-6)
+    return np.where(moved, ((mz * slope + intercept) - mass) / mass * 1e6, error)
+
+
+def ConfirmLinkedCandidates(annotation, data):
+    # Pairs of (feature, SwissLipids ID) found in the annotation of both
+    # features of a pos/neg link
+    links = data.loc[data.Index_Othermode.isin(data.Lipid_ID), ["Lipid_ID", "Index_Othermode"]]
+    links = links.rename(columns={"Index_Othermode": "Other_ID"})
+    links = pd.concat([links, links.rename(columns={"Lipid_ID": "Other_ID", "Other_ID": "Lipid_ID"})])
+    links = links.drop_duplicates()
+
+    candidates = annotation[["Lipid_ID", "SwissLipids_ID"]].drop_duplicates()
+    confirmed = links.merge(candidates, on="Lipid_ID").merge(
+        candidates.rename(columns={"Lipid_ID": "Other_ID"}), on=["Other_ID", "SwissLipids_ID"])
+    confirmed = confirmed[["Lipid_ID", "SwissLipids_ID"]].drop_duplicates()
+
+    # Features without any confirmed candidate keep all of their candidates
+    keep = ~annotation.Lipid_ID.isin(confirmed.Lipid_ID).values
+    keep |= pd.MultiIndex.from_frame(annotation[["Lipid_ID", "SwissLipids_ID"]]).isin(
+        pd.MultiIndex.from_frame(confirmed)
+    )
+    return annotation[keep].reset_index(drop=True)
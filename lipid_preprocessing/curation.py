@@ -0,0 +1,172 @@
+import pandas as pd
+import re
+from .reference import GetReferenceKey, GetReferenceTable
+
+
+def CheckAnnotation(representatives, curation):
+    representatives = pd.merge(representatives, curation, how="left")
+
+    pre_columns = list(representatives.columns)
+
+    repl = representatives.drop_duplicates(subset=['Class_SwissLipids'], keep="first")
+    repl['Abbreviation_SwissLipids'] = repl['Abbreviation_SwissLipids'].str.replace('\(d', '(')
+    repl['Abbreviation_SwissLipids'] = repl['Abbreviation_SwissLipids'].str.replace(' \(O-', '_O(')
+    repl['Abbreviation_SwissLipids'] = repl['Abbreviation_SwissLipids'].str.replace('\(O-', '_O(')
+    repl['Abbreviation_SwissLipids'] = repl['Abbreviation_SwissLipids'].str.replace(' \(P-', '_P(')
+    repl['Abbreviation_SwissLipids'] = repl['Abbreviation_SwissLipids'].str.replace('\(P-', '_P(')
+
+    tmp = repl["Abbreviation_SwissLipids"].str.split("(", n=1, expand=True)
+    repl["Class_Abbr_SL"] = tmp[0]
+    repl = repl[["Class_SwissLipids", "Class_Abbr_SL"]]
+
+    anno = GetReferenceTable("full_classes")
+    anno["Annotation"] = anno["Abbreviation_LipidMaps"]
+    anno = anno[["SwissLipids_ID", "Annotation", "Class_SwissLipids", "Abbreviation_SwissLipids",
+                 "LipidMaps_ID", "Class_LipidMaps", "Abbreviation_LipidMaps", "SwissLipids_name"]]
+    anno = anno.reset_index(drop=True)
+
+    lm_classes = list(anno.Class_LipidMaps.drop_duplicates().values)
+    lm_classes.sort()
+    if "-" in lm_classes:
+        lm_classes = lm_classes[1:]
+
+    cls_df = pd.DataFrame(columns=["Class_LipidMaps", "Class_Abbr_LM"])
+    for cl in lm_classes:
+        abb = re.findall(r'\[(.+)\]', str(cl))
+        cls_df = cls_df.append({"Class_LipidMaps": cl,
+                                "Class_Abbr_LM": abb[0]},
+                               ignore_index=True)
+
+    representatives = pd.merge(representatives, repl, how="left")
+    representatives = pd.merge(representatives, cls_df, how="left")
+    representatives.loc[representatives["Class_Abbr_SL"].isnull(), "Class_Abbr_SL"] = "-"
+    representatives.loc[representatives["Class_Abbr_LM"].isnull(), "Class_Abbr_LM"] = "-"
+    representatives.loc[representatives["Class_Abbr_SL"] == "DHDG", "Class_Abbr_SL"] = "FA"
+    representatives.loc[representatives["Class_SwissLipids"] == "Fatty acid methyl esters",
+                        "Class_Abbr_SL"] = "FA"
+
+    representatives = representatives[pre_columns]
+    print("Not in index:\n", representatives.columns)
+    representatives = representatives[['SwissLipids_ID', 'Lipid_ID', 'Annotation', 'Curation',
+                                       'Class_SwissLipids', 'Abbreviation_SwissLipids', 'LipidMaps_ID',
+                                       'Class_LipidMaps', 'Abbreviation_LipidMaps', 'SwissLipids_name']]
+
+    representatives.loc[representatives["Annotation"] == representatives["SwissLipids_name"], "Annotation"] = "-"
+    representatives['Annotation'] = representatives['Annotation'].str.replace(' \(O-', '_O(')
+    representatives['Annotation'] = representatives['Annotation'].str.replace('\(O-', '_O(')
+    representatives['Annotation'] = representatives['Annotation'].str.replace(' \(P-', '_P(')
+    representatives['Annotation'] = representatives['Annotation'].str.replace('\(P-', '_P(')
+    representatives['Annotation'] = representatives['Annotation'].str.replace(' \(', '(')
+
+    representatives.loc[~representatives["Annotation"].str.contains("NAPE"),
+                        "Annotation"] = representatives['Annotation'].str.replace('\)', '')
+    representatives.loc[~representatives["Annotation"].str.contains("NAPE"),
+                        "Annotation"] = representatives['Annotation'].str.replace('\(', ' ')
+
+    representatives.loc[representatives["Annotation"] == "-",
+                        "Annotation"] = representatives["SwissLipids_name"]
+
+    # Real check
+    representatives["OK"] = "-"
+    representatives.loc[representatives["Annotation"] == representatives["Curation"], "OK"] = "+"
+
+    representatives = representatives[representatives.OK == "+"]
+
+    representatives = representatives[['Lipid_ID', 'SwissLipids_ID']]
+
+    return representatives
+
+
+def GetRepresentativesClasses(representatives):
+    annotation = GetReferenceTable("full_classes")
+    annotation["Annotation"] = annotation["Abbreviation_LipidMaps"]
+    annotation = annotation[["SwissLipids_ID", "Annotation", "Class_SwissLipids", "Abbreviation_SwissLipids",
+                             "LipidMaps_ID", "Class_LipidMaps", "Abbreviation_LipidMaps", "SwissLipids_name"]]
+    annotation = annotation[annotation.SwissLipids_ID != "-"]
+    annotation = annotation.reset_index(drop=True)
+
+    annotation.loc[annotation["Annotation"] == "-", "Annotation"] = annotation["Abbreviation_SwissLipids"]
+    annotation.loc[annotation["Annotation"] == "-", "Annotation"] = annotation["SwissLipids_name"]
+    annotation = annotation.drop_duplicates()
+    annotation = annotation.reset_index(drop=True)
+
+    print("annotation:\n", annotation.head())
+    print(annotation.columns)
+    print("representatives:\n", representatives.head())
+    representatives.columns = ["SwissLipids_ID", "Lipid_ID"]
+
+    representatives = pd.merge(representatives, annotation, how="left")
+
+    return representatives
+
+
+'''
+    Vectorized curation check: the annotations of full_classes_data_LM_SWL.csv
+    are normalized once into the curation format and kept per file version,
+    so checking the representatives is a join on (SwissLipids_ID, Curation)
+'''
+
+# " (O-", "(O-", " (P-", "(P-" -> "_O(", "_P(" and " (" -> "("
+ANNOTATION_PATTERN = re.compile(r" ?\(([OP])-| \(")
+ANNOTATION_BRACKETS = str.maketrans({")": None, "(": " "})
+
+_NORMALIZED_ANNOTATIONS = {}
+
+
+def CheckAnnotationBatch(representatives, curation):
+    # "representatives" should be pd.DataFrame: --- SwissLipids_ID, Lipid_ID ---
+    lookup = GetNormalizedAnnotations()
+
+    curation = curation[["Lipid_ID", "Curation"]]
+    curation = curation[curation.Curation.notnull()]
+
+    checked = pd.merge(representatives[["SwissLipids_ID", "Lipid_ID"]], lookup, on="SwissLipids_ID")
+    checked = pd.merge(checked, curation, on=["Lipid_ID", "Curation"])
+    checked = checked[['Lipid_ID', 'SwissLipids_ID']]
+    checked = checked.reset_index(drop=True)
+
+    return checked
+
+
+def GetNormalizedAnnotations():
+    key = GetReferenceKey("full_classes")
+    if key not in _NORMALIZED_ANNOTATIONS:
+        _NORMALIZED_ANNOTATIONS.clear()
+        _NORMALIZED_ANNOTATIONS[key] = NormalizeAnnotations(GetReferenceTable("full_classes"))
+    return _NORMALIZED_ANNOTATIONS[key]
+
+
+def NormalizeAnnotations(annotation):
+    # Same annotation table as in GetRepresentativesClasses
+    annotation["Annotation"] = annotation["Abbreviation_LipidMaps"]
+    annotation = annotation[["SwissLipids_ID", "Annotation", "Class_SwissLipids", "Abbreviation_SwissLipids",
+                             "LipidMaps_ID", "Class_LipidMaps", "Abbreviation_LipidMaps", "SwissLipids_name"]]
+    annotation = annotation[annotation.SwissLipids_ID != "-"]
+    annotation = annotation.reset_index(drop=True)
+
+    annotation.loc[annotation["Annotation"] == "-", "Annotation"] = annotation["Abbreviation_SwissLipids"]
+    annotation.loc[annotation["Annotation"] == "-", "Annotation"] = annotation["SwissLipids_name"]
+    annotation = annotation.drop_duplicates()
+
+    curation = [NormalizeAnnotation(a, n) for a, n in zip(annotation.Annotation, annotation.SwissLipids_name)]
+
+    lookup = pd.DataFrame({"SwissLipids_ID": annotation.SwissLipids_ID.values,
+                           "Curation": curation})
+    lookup = lookup[lookup.Curation.notnull()]
+    lookup = lookup.reset_index(drop=True)
+    return lookup
+
+
+def NormalizeAnnotation(annotation, swl_name):
+    if not isinstance(annotation, str):
+        return None
+    if annotation == swl_name:
+        return swl_name
+
+    annotation = ANNOTATION_PATTERN.sub(lambda m: "_%s(" % m.group(1) if m.group(1) else "(", annotation)
+    if "NAPE" not in annotation:
+        annotation = annotation.translate(ANNOTATION_BRACKETS)
+
+    if annotation == "-":
+        return swl_name
+    return annotation
@@ -0,0 +1,137 @@
+import pandas as pd
+import numpy as np
+import os
+import json
+import shutil
+import hashlib
+from .storage import CommitCacheDirectory, GetChecksums, GetDefaultTableFormat, ReadTable, WriteTable
+from .annotation import ANNOTATION_DTYPES, AddAdducts, AnnotateDataWithLipyd, GetDatabaseFiles
+from .representatives import GetRepresentatives
+
+
+'''
+    Incremental annotation: the annotation of every feature, keyed on
+    (Lipid_ID, MZ, Mode, Adduct), is kept in a store under cache/incremental,
+    and the statuses of every resolved SwissLipids ID in the representatives
+    memo next to it, so a rerun on a grown feature table only processes the
+    new or changed features and the SwissLipids IDs it has not seen before.
+    Every update of the annotation is written as a new generation directory
+'''
+
+INCREMENTAL_STORE_VERSION = 1
+FEATURE_KEY = ["Lipid_ID", "MZ", "Mode", "Adduct"]
+
+
+def AnnotateDataIncremental(data, adducts=None, store_dir="cache/incremental", table_format=None, **kwargs):
+    # Same input as AnnotateDataWithLipyd, the rest is passed to it
+    features = GetFeatureKeys(data, adducts)
+
+    key = GetIncrementalStoreKey("annotation", GetDatabaseFiles(download=True), kwargs)
+    path = os.path.join(store_dir, "annotation", key)
+    store, generation = ReadIncrementalStore(path, ["features", "annotation"])
+
+    if store is None:
+        store = {"features": features.iloc[0:0],
+                 "annotation": pd.DataFrame(columns=list(ANNOTATION_DTYPES))}
+
+    # Features with unchanged keys keep their stored annotation, a duplicated
+    # Lipid_ID only when all of its rows are unchanged
+    signatures = GetFeatureSignatures(features)
+    stored = GetFeatureSignatures(GetFeatureKeys(store["features"]))
+    known_ids = signatures.index[signatures.eq(stored.reindex(signatures.index)).values]
+
+    new_data = data[~data.Lipid_ID.astype(str).isin(known_ids)]
+    print("...Annotating %d new or changed of %d features..." % (len(new_data), len(data)))
+
+    annotation = store["annotation"]
+    annotation = annotation[annotation.Lipid_ID.astype(str).isin(known_ids)]
+    if len(new_data) > 0:
+        annotation = pd.concat([annotation,
+                                AnnotateDataWithLipyd(new_data, adducts=adducts, **kwargs)])
+
+    # Same order as a full run: positive then negative features, in input order.
+    # A duplicated Lipid_ID sorts at its first row, its candidates keep their order
+    ids = annotation.Lipid_ID.astype(str).values
+    first = ~data.Lipid_ID.astype(str).duplicated().values
+    position = pd.Series(np.arange(len(data))[first], index=data.Lipid_ID.astype(str).values[first])
+    mode_order = pd.Series((data.Mode != "pos").astype(int).values[first], index=position.index)
+    order = np.lexsort((position.reindex(ids).values, mode_order.reindex(ids).values))
+    annotation = annotation.iloc[order].reset_index(drop=True)
+
+    if len(new_data) > 0 or len(features) != len(store["features"]):
+        WriteIncrementalStore(path, {"features": features, "annotation": annotation},
+                              generation + 1, table_format)
+    return annotation
+
+
+def GetRepresentativesIncremental(data, store_dir="cache/incremental", backend="networkx"):
+    # The statuses of known SwissLipids IDs come from the representatives
+    # memo kept in the store, the compress/no-species rules of
+    # GetRepresentatives are applied over all of them, as in a full run
+    return GetRepresentatives(data, backend=backend, memo_dir=os.path.join(store_dir, "representatives"))
+
+
+def GetFeatureKeys(data, adducts=None):
+    if adducts is not None:
+        data = AddAdducts(data, adducts)
+    features = pd.DataFrame({"Lipid_ID": data.Lipid_ID.astype(str).values,
+                             "MZ": data.MZ.values.astype(float),
+                             "Mode": data.Mode.astype(str).values,
+                             "Adduct": data.Adduct.astype(str).values if "Adduct" in data.columns else "-"},
+                            columns=FEATURE_KEY)
+    return features
+
+
+def GetFeatureSignatures(features):
+    keys = features.Lipid_ID.astype(str)
+    for column in FEATURE_KEY[1:]:
+        keys = keys + "/" + features[column].astype(str)
+    return keys.groupby(features.Lipid_ID.values).agg(lambda rows: "|".join(sorted(rows))).astype(object)
+
+
+def GetIncrementalStoreKey(name, files, params):
+    # Settings which do not change the results are left out
+    params = {k: v for k, v in params.items() if k not in ("n_jobs", "chunk_size", "cache_dir")}
+    key = json.dumps({"version": INCREMENTAL_STORE_VERSION,
+                      "store": name,
+                      "files": GetChecksums(files),
+                      "params": params}, sort_keys=True, default=sorted)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def ReadIncrementalStore(path, names):
+    generations = []
+    if os.path.isdir(path):
+        generations = sorted(int(g) for g in os.listdir(path) if g.isdigit())
+
+    for generation in reversed(generations):
+        generation_path = os.path.join(path, "%06d" % generation)
+        if not os.path.exists(os.path.join(generation_path, "meta.json")):
+            continue
+        with open(os.path.join(generation_path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        print("...Loading incremental store (generation %d)..." % generation)
+        store = {name: ReadTable(os.path.join(generation_path, "%s.%s" % (name, meta["format"])))
+                 for name in names}
+        return store, generation
+
+    return None, 0
+
+
+def WriteIncrementalStore(path, tables, generation, table_format=None):
+    if table_format is None:
+        table_format = GetDefaultTableFormat()
+
+    tmp_path = os.path.join(path, "tmp%d" % os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    for name, table in tables.items():
+        WriteTable(table, os.path.join(tmp_path, "%s.%s" % (name, table_format)))
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({"version": INCREMENTAL_STORE_VERSION, "format": table_format}, f)
+
+    CommitCacheDirectory(tmp_path, os.path.join(path, "%06d" % generation))
+
+    # Older generations are superseded
+    for g in os.listdir(path):
+        if g.isdigit() and int(g) < generation:
+            shutil.rmtree(os.path.join(path, g), ignore_errors=True)
@@ -0,0 +1,263 @@
+import pandas as pd
+import numpy as np
+import os
+import profiling
+from .storage import GetDefaultTableFormat, ReadTable, WriteTable
+from .reference import GetReferenceTable
+
+
+''' 
+    This part is dedicated to getting lipids from representatives
+'''
+
+
+def RepresentativesToLipids(representatives, repr_to_swl):
+    representatives.columns = ["Lipid_ID", "Representative_ID"]
+    annotated_data = pd.merge(representatives, repr_to_swl)
+    annotated_data = annotated_data[["Lipid_ID", "SwissLipids_ID", "Representative_ID"]]
+    return annotated_data
+
+
+''' 
+    This part is dedicated to getting lipids from representatives
+'''
+
+
+def MappingToGraph(annotated_data, closure=None):
+    annotated_data["Depth"] = 0
+    annotated_data["Initial_SwissLipids_ID"] = annotated_data["SwissLipids_ID"]
+
+    annotated_data = AddingLevelsToAnnotatedData(annotated_data)
+    annotated_data = InheritingReactions(annotated_data, closure=closure)
+
+    return annotated_data
+
+
+INHERITANCE_COLUMNS = ["Lipid_ID", "ChEBI_ID", "SwissLipids_ID",
+                       "Initial_SwissLipids_ID", "Depth",
+                       "Representative_ID"]
+PARENT_COLUMNS = {"ChEBI_ID": "Parental_ChEBI_ID", "SwissLipids_ID": "Parent"}
+
+
+@profiling.Profiled("inheriting_reactions")
+def InheritingReactions(annotated_data, closure=None):
+    acyclic = GetReferenceTable("acyclic")
+
+    # Same join keys as the merge in GetParents
+    keys = [column for column in INHERITANCE_COLUMNS if column in acyclic.columns]
+    if not set(keys) <= set(PARENT_COLUMNS):
+        return InheritingReactionsIterative(annotated_data, acyclic)
+
+    if closure is None:
+        closure = CompileAncestorClosure(acyclic, keys)
+
+    # Rows with missing values are never expanded by GetParents
+    seeds = annotated_data[INHERITANCE_COLUMNS]
+    seeds = seeds[seeds.notnull().all(axis=1)].drop(columns=["Depth"])
+    seeds = seeds.assign(Seed=np.arange(len(seeds)))
+
+    ancestors = pd.merge(seeds, closure, how="inner", on=keys)
+    profiling.Count("graph_nodes_visited", len(ancestors))
+    ancestors = ancestors.sort_values(["Depth", "Seed", "Order"], kind="stable")
+    ancestors = ancestors[["Lipid_ID", "Parental_ChEBI_ID", "Parent", "Level",
+                           "Initial_SwissLipids_ID", "Depth",
+                           "Representative_ID"]]
+    ancestors.columns = ["Lipid_ID", "ChEBI_ID", "SwissLipids_ID", "Level",
+                         "Initial_SwissLipids_ID", "Depth",
+                         "Representative_ID"]
+
+    current = pd.concat([annotated_data, ancestors])
+    current = current.drop_duplicates()
+    current = current[current.ChEBI_ID != "-"]
+    current = current.reset_index(drop=True)
+
+    return current
+
+
+@profiling.Profiled("ancestor_closure")
+def CompileAncestorClosure(acyclic, keys):
+    import networkx as nx
+
+    # For every node of the acyclic graph: all ancestor rows with their depth,
+    # in the order the level-by-level expansion of GetParents finds them
+    edges = acyclic.dropna()
+    children = list(zip(*[edges[key] for key in keys]))
+    rows = list(zip(edges.Parental_ChEBI_ID, edges.Parent, edges.Level))
+
+    def Node(row):
+        return tuple(row[0] if key == "ChEBI_ID" else row[1] for key in keys)
+
+    parents = {}
+    g = nx.DiGraph()
+    for child, row in zip(children, rows):
+        parents.setdefault(child, []).append(row)
+        g.add_edge(child, Node(row))
+
+    closure = {}
+    for node in reversed(list(nx.topological_sort(g))):
+        first = list(dict.fromkeys(parents.get(node, [])))
+        depths = []
+        level = first
+        while level:
+            depths.append(level)
+            k = len(depths)
+            level = list(dict.fromkeys(row for parent in first
+                                       for row in GetClosureLevel(closure, Node(parent), k)))
+        closure[node] = depths
+
+    records = []
+    for node, depths in closure.items():
+        for depth, level in enumerate(depths):
+            for order, row in enumerate(level):
+                records.append(node + row + (depth + 1, order))
+
+    closure = pd.DataFrame.from_records(records, columns=keys + ["Parental_ChEBI_ID", "Parent", "Level",
+                                                                 "Depth", "Order"])
+    return closure
+
+
+def GetClosureLevel(closure, node, k):
+    depths = closure.get(node, [])
+    return depths[k - 1] if k <= len(depths) else []
+
+
+def InheritingReactionsIterative(annotated_data, acyclic):
+    current = annotated_data
+    res = annotated_data
+    depth = 0
+
+    while len(res) > 0:
+        res = GetParents(data=res, acyclic_graph=acyclic, depth=depth)
+        profiling.Count("graph_nodes_visited", len(res))
+        current = pd.concat([current, res])
+        depth += 1
+
+    current = current.drop_duplicates()
+    current = current[current.ChEBI_ID != "-"]
+    current = current.reset_index(drop=True)
+
+    return current
+
+
+def GetParents(data, acyclic_graph, depth):
+    data = data[["Lipid_ID", "ChEBI_ID", "SwissLipids_ID",
+                 "Initial_SwissLipids_ID", "Depth",
+                 "Representative_ID"]]
+
+    merged = pd.merge(left=data, right=acyclic_graph, how='left')
+
+    merged['Checker'] = np.where(merged['Parental_ChEBI_ID'].isnull(), True, False)
+    merged_next = merged.dropna()
+
+    merged_next["Depth"] = depth + 1
+
+    merged_next = merged_next[["Lipid_ID", "Parental_ChEBI_ID", "Parent", "Level",
+                               "Initial_SwissLipids_ID", "Depth",
+                               "Representative_ID"]]
+
+    merged_next.columns = ["Lipid_ID", "ChEBI_ID", "SwissLipids_ID", "Level",
+                           "Initial_SwissLipids_ID", "Depth",
+                           "Representative_ID"]
+    return merged_next
+
+
+def AddingLevelsToAnnotatedData(annotated_data):
+    levels_data = GetReferenceTable("levels")
+
+    annotated_data = pd.merge(annotated_data, levels_data,
+                              how='left',
+                              left_on="SwissLipids_ID",
+                              right_on="SwissLipids_ID")
+
+    lm_ch_pch_swl = GetReferenceTable("chebi")
+    lm_ch_pch_swl = lm_ch_pch_swl[["ChEBI_ID", "SwissLipids_ID"]]
+
+    annotated_data = pd.merge(annotated_data, lm_ch_pch_swl,
+                              how='left',
+                              left_on="SwissLipids_ID",
+                              right_on="SwissLipids_ID")
+
+    annotated_data.loc[annotated_data["Level"].isnull(), "Level"] = "-"
+    annotated_data = annotated_data[["Lipid_ID", "ChEBI_ID", "SwissLipids_ID",
+                                     "Level", "Initial_SwissLipids_ID",
+                                     "Depth", "Representative_ID"]]
+    return annotated_data
+
+
+'''
+    Sparse output: the long feature -> ChEBI table as a scipy.sparse CSR
+    matrix of features x ChEBI IDs, with the row and column index tables
+    stored next to it. A stored value is the smallest depth at which the
+    ChEBI ID is reached from the feature plus one, so 1 marks the direct
+    annotation and every stored entry stays non-zero
+'''
+
+MATRIX_DTYPE = np.int16
+
+
+def BuildIncidenceMatrix(annotated_data, lipid_ids=None):
+    import scipy.sparse as sp
+
+    edges = annotated_data[["Lipid_ID", "ChEBI_ID", "Depth"]]
+    edges = edges[edges.ChEBI_ID.notnull() & (edges.ChEBI_ID != "-")]
+
+    # Rows follow "lipid_ids" (e.g. the feature table), columns are sorted ChEBI IDs
+    if lipid_ids is None:
+        lipid_ids = edges.Lipid_ID.drop_duplicates()
+    rows = pd.DataFrame({"Lipid_ID": pd.Series(lipid_ids).drop_duplicates().values})
+    rows.index.name = "Row"
+    columns = pd.DataFrame({"ChEBI_ID": np.sort(edges.ChEBI_ID.astype(str).unique())})
+    columns.index.name = "Column"
+
+    row = pd.Index(rows.Lipid_ID).get_indexer(edges.Lipid_ID)
+    column = pd.Index(columns.ChEBI_ID).get_indexer(edges.ChEBI_ID.astype(str))
+    depth = edges.Depth.values.astype(np.int64)
+    known = row >= 0
+    row, column, depth = row[known], column[known], depth[known]
+
+    row, column, depth = GetSmallestDepths(row, column, depth)
+    matrix = sp.csr_matrix(((depth + 1).astype(MATRIX_DTYPE), (row, column)),
+                           shape=(len(rows), len(columns)))
+    return matrix, rows, columns
+
+
+def GetSmallestDepths(row, column, depth):
+    # Smallest depth of every (row, column) pair
+    order = np.lexsort((depth, column, row))
+    row, column, depth = row[order], column[order], depth[order]
+    first = np.ones(len(row), dtype=bool)
+    first[1:] = (np.diff(row) != 0) | (np.diff(column) != 0)
+    return row[first], column[first], depth[first]
+
+
+def WriteIncidenceMatrix(matrix, rows, columns, path, table_format=None):
+    # "path" is a prefix: <path>.npz, <path>_rows.<format>, <path>_columns.<format>
+    import scipy.sparse as sp
+
+    if table_format is None:
+        table_format = GetDefaultTableFormat()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    sp.save_npz("%s.npz" % path, matrix)
+    WriteTable(rows.reset_index(), "%s_rows.%s" % (path, table_format))
+    WriteTable(columns.reset_index(), "%s_columns.%s" % (path, table_format))
+
+
+def ReadIncidenceMatrix(path):
+    import scipy.sparse as sp
+
+    matrix = sp.load_npz("%s.npz" % path)
+    tables = []
+    for name in ["rows", "columns"]:
+        files = [f for f in ["%s_%s.parquet" % (path, name), "%s_%s.csv" % (path, name)] if os.path.exists(f)]
+        if len(files) == 0:
+            raise FileNotFoundError("%s_%s.parquet or %s_%s.csv is missing" % (path, name, path, name))
+        # Both formats exist when the matrix was rewritten with another --format
+        table_file = max(files, key=os.path.getmtime)
+        if os.path.getsize(table_file) == 0:
+            raise ValueError("%s is empty" % table_file)
+        tables.append(ReadTable(table_file).set_index("Row" if name == "rows" else "Column"))
+
+    if (len(tables[0]), len(tables[1])) != matrix.shape:
+        raise ValueError("%s.npz is %d x %d, its index tables have %d rows and %d columns"
+                         % (path, matrix.shape[0], matrix.shape[1], len(tables[0]), len(tables[1])))
+    return matrix, tables[0], tables[1]
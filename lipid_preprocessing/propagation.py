@@ -0,0 +1,169 @@
+import pandas as pd
+import numpy as np
+import os
+import profiling
+from .storage import GetDefaultTableFormat, WriteTable
+from .reference import GetReferenceKey, GetReferenceTable
+from .mapping import MATRIX_DTYPE, BuildIncidenceMatrix, GetSmallestDepths
+
+
+'''
+    Ontology propagation: acyclic_graph.csv is compiled once into a sparse
+    ChEBI x ChEBI operator holding every ChEBI ID with itself and all of its
+    ancestors, valued with the smallest depth plus one like the sparse
+    output. Feature-level values of many samples (features x samples) are
+    aggregated to every reached ChEBI ID with one sparse matrix product
+'''
+
+AGGREGATIONS = ["sum", "max", "count", "depth_weighted"]
+
+# Largest (features x samples) block gathered at once for "max"
+MAX_BLOCK_SIZE = 1 << 24
+
+_ONTOLOGY_OPERATORS = {}
+
+
+def GetOntologyOperator():
+    key = GetReferenceKey("acyclic")
+    if key not in _ONTOLOGY_OPERATORS:
+        _ONTOLOGY_OPERATORS.clear()
+        _ONTOLOGY_OPERATORS[key] = CompileOntologyOperator(GetReferenceTable("acyclic"))
+    return _ONTOLOGY_OPERATORS[key]
+
+
+@profiling.Profiled("ontology_operator")
+def CompileOntologyOperator(acyclic):
+    import scipy.sparse as sp
+
+    edges = acyclic[["ChEBI_ID", "Parental_ChEBI_ID"]].dropna().astype(str)
+    edges = edges[(edges.ChEBI_ID != "-") & (edges.Parental_ChEBI_ID != "-")].drop_duplicates()
+
+    nodes = pd.DataFrame({"ChEBI_ID": np.sort(pd.unique(edges.values.ravel()))})
+    nodes.index.name = "Node"
+    index = pd.Index(nodes.ChEBI_ID)
+    n = len(nodes)
+
+    parents = sp.csr_matrix((np.ones(len(edges), dtype=np.int32),
+                             (index.get_indexer(edges.ChEBI_ID), index.get_indexer(edges.Parental_ChEBI_ID))),
+                            shape=(n, n))
+
+    # Breadth-first expansion of all nodes at once: "frontier" holds the
+    # ancestors first reached at the current depth
+    operator = sp.identity(n, dtype=MATRIX_DTYPE, format="csr")
+    frontier = sp.identity(n, dtype=np.int32, format="csr")
+    depth = 0
+    while frontier.nnz:
+        depth += 1
+        if depth > n:
+            raise ValueError("acyclic_graph.csv has a cycle")
+
+        reached = frontier @ parents
+        reached.data[:] = 1
+        frontier = reached - reached.multiply(operator > 0)
+        frontier.eliminate_zeros()
+        operator = operator + frontier.astype(MATRIX_DTYPE) * (depth + 1)
+
+    profiling.Count("graph_nodes_visited", operator.nnz)
+    return operator.tocsr(), nodes
+
+
+@profiling.Profiled("propagation")
+def PropagateToOntology(annotated_data, values, aggregations=None, decay=0.5, operator=None):
+    # "annotated_data" is the ChEBI mapping (only its Depth 0 rows are used),
+    # "values" is a features x samples table indexed by Lipid_ID.
+    # Returns a ChEBI_ID x samples table for every aggregation
+    if aggregations is None:
+        aggregations = AGGREGATIONS
+    unknown = set(aggregations) - set(AGGREGATIONS)
+    if unknown:
+        raise ValueError("unknown aggregations: %s" % ", ".join(sorted(unknown)))
+
+    if not values.index.is_unique:
+        raise ValueError("values need one row per Lipid_ID")
+    if operator is None:
+        operator = GetOntologyOperator()
+
+    reached, nodes = GetReachedNodes(annotated_data, values.index, operator)
+    profiling.Count("graph_nodes_visited", reached.nnz)
+
+    samples = values.to_numpy(dtype=np.float64)
+    detected = ~np.isnan(samples) & (samples != 0)
+    samples = np.nan_to_num(samples)
+
+    # Only ChEBI IDs reached by at least one feature are reported
+    used = np.flatnonzero(np.diff(reached.tocsc().indptr))
+    reached = reached[:, used]
+    chebi_ids = pd.Index(nodes.ChEBI_ID.values[used], name="ChEBI_ID")
+
+    member = reached.copy()
+    member.data = np.ones(len(member.data))
+
+    propagated = {}
+    for aggregation in aggregations:
+        if aggregation == "sum":
+            result = member.T @ samples
+        elif aggregation == "count":
+            result = member.T @ detected.astype(np.float64)
+        elif aggregation == "depth_weighted":
+            weights = reached.copy()
+            weights.data = decay ** (reached.data.astype(np.float64) - 1)
+            result = weights.T @ samples
+        else:
+            result = GetColumnMaxima(reached, values.to_numpy(dtype=np.float64))
+        propagated[aggregation] = pd.DataFrame(result, index=chebi_ids, columns=values.columns)
+
+    return propagated
+
+
+def GetReachedNodes(annotated_data, lipid_ids, operator):
+    # Features x ChEBI IDs with the smallest depth plus one, the same values
+    # BuildIncidenceMatrix gives for the output of InheritingReactions
+    import scipy.sparse as sp
+
+    operator, nodes = operator
+    direct, _, columns = BuildIncidenceMatrix(annotated_data[annotated_data.Depth == 0], lipid_ids=lipid_ids)
+    direct = direct.tocoo()
+
+    # Annotated ChEBI IDs outside of acyclic_graph.csv only reach themselves
+    position = pd.Index(nodes.ChEBI_ID).get_indexer(columns.ChEBI_ID)
+    extra = columns.ChEBI_ID.values[position < 0]
+    if len(extra):
+        position[position < 0] = len(nodes) + np.arange(len(extra))
+        operator = sp.block_diag([operator, sp.identity(len(extra), dtype=MATRIX_DTYPE)], format="csr")
+        nodes = pd.DataFrame({"ChEBI_ID": np.r_[nodes.ChEBI_ID.values, extra]})
+
+    # Gathering the operator row of every annotated ChEBI ID
+    node = position[direct.col]
+    starts = operator.indptr[node]
+    lengths = operator.indptr[node + 1] - starts
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    entries = np.repeat(starts, lengths) + offsets
+
+    row, column, depth = GetSmallestDepths(np.repeat(direct.row, lengths), operator.indices[entries],
+                                           operator.data[entries])
+    reached = sp.csr_matrix((depth, (row, column)), shape=(direct.shape[0], len(nodes)))
+    return reached, nodes
+
+
+def GetColumnMaxima(reached, samples):
+    # Maxima over the features of every column, ignoring missing values
+    reached = reached.tocsc()
+    starts = reached.indptr[:-1]
+    result = np.full((reached.shape[1], samples.shape[1]), np.nan)
+    if reached.nnz == 0:
+        return result
+
+    block = max(1, MAX_BLOCK_SIZE // max(1, reached.nnz))
+    for i in range(0, samples.shape[1], block):
+        gathered = samples[reached.indices, i:i + block]
+        with np.errstate(invalid="ignore"):
+            result[:, i:i + block] = np.fmax.reduceat(gathered, starts, axis=0)
+    return result
+
+
+def WritePropagatedValues(propagated, path):
+    # "path" is a prefix: <path>_<aggregation>.<format>
+    table_format = GetDefaultTableFormat()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    for aggregation, table in propagated.items():
+        WriteTable(table.reset_index(), "%s_%s.%s" % (path, aggregation, table_format))
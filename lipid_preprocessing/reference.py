@@ -0,0 +1,58 @@
+import pandas as pd
+import os
+import functools
+import profiling
+
+
+''' 
+    This part is dedicated to reference data: every table is loaded lazily,
+    once per process, and reloaded only when its file changes
+'''
+
+REFERENCE_DIR = "data"
+
+# Categorical columns always get the "-" category used for missing values
+REFERENCE_TABLES = {
+    "levels": {"file": "levels_data.csv",
+               "names": ["SwissLipids_ID", "Level"],
+               "categories": ["SwissLipids_ID", "Level"]},
+    "full_classes": {"file": "full_classes_data_LM_SWL.csv",
+                     "categories": ["SwissLipids_ID", "LipidMaps_ID",
+                                    "Class_SwissLipids", "Class_LipidMaps"]},
+    "acyclic": {"file": "acyclic_graph.csv",
+                "categories": ["ChEBI_ID", "Parental_ChEBI_ID", "Parent", "Level"]},
+    "chebi": {"file": "lipidmaps_to_chebi_to_pubchem_to_swisslipids.csv",
+              "usecols": ["ChEBI_ID", "SwissLipids_ID"],
+              "categories": ["ChEBI_ID", "SwissLipids_ID"]},
+}
+
+
+def GetReferenceTable(name):
+    # Callers modify the tables they get, so every call hands out a copy
+    return LoadReferenceTable(*GetReferenceKey(name)).copy()
+
+
+def GetReferenceKey(name):
+    path = os.path.abspath(os.path.join(REFERENCE_DIR, REFERENCE_TABLES[name]["file"]))
+    stat = os.stat(path)
+    return name, path, stat.st_mtime_ns, stat.st_size
+
+
+@functools.lru_cache(maxsize=16)
+@profiling.Profiled("read_reference")
+def LoadReferenceTable(name, path, mtime, size):
+    spec = REFERENCE_TABLES[name]
+
+    header = pd.read_csv(path, sep=",", nrows=0)
+    columns = spec.get("names", list(header.columns))
+    categories = [column for column in spec["categories"] if column in columns]
+
+    table = pd.read_csv(path, sep=",", header=0, names=spec.get("names"),
+                        usecols=spec.get("usecols"),
+                        dtype={column: "category" for column in categories})
+
+    for column in categories:
+        if column in table.columns and "-" not in table[column].cat.categories:
+            table[column] = table[column].cat.add_categories("-")
+
+    return table
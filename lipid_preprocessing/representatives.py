@@ -0,0 +1,676 @@
+import pandas as pd
+import numpy as np
+import os
+import json
+import hashlib
+import networkx as nx
+import profiling
+from .storage import (CommitCacheDirectory, FileLock, GetChecksums, GetDefaultTableFormat, GetTableFormat, ReadTable,
+                      WriteTable)
+from .reference import GetReferenceTable
+from .curation import CheckAnnotationBatch
+from .mapping import CompileAncestorClosure, INHERITANCE_COLUMNS, PARENT_COLUMNS
+
+
+''' 
+    This part is dedicated to getting representatives
+'''
+
+
+@profiling.Profiled("representatives")
+def GetRepresentatives(data, curation=None, check_annotation=False, backend="networkx",
+                       memo_dir="cache/representatives", graph=None, summary=None, no_species_summary=None):
+    # "graph" and the summaries can be compiled once and reused across calls
+    levels_data = GetReferenceTable("levels")
+
+    print("...Adding levels to data...")
+    # Adding levels to data
+    swl_ids = AddingLevelsToData(data, levels_data)
+
+    # Statuses of the SwissLipids IDs resolved by previous runs
+    memo = LoadRepresentativesMemo(memo_dir)
+    unknown = swl_ids[~swl_ids.SwissLipids_ID.isin(memo.SwissLipids_ID)].reset_index(drop=True)
+
+    getting_error = []
+    if len(unknown) > 0:
+        # Creating graph
+        g = graph
+        if g is None and backend == "snapshot":
+            g = LoadGraphSnapshot()
+        elif g is None:
+            g = CreateAnnotatedGraph(levels_data, backend=backend)
+
+        # Getting representatives
+        print("...Getting representatives of %d SwissLipids IDs..." % len(unknown))
+        if summary is None:
+            summary = CompileSpeciesSummary(g)
+        representatives, more_species, no_species, getting_error = ResolveRepresentatives(unknown, summary)
+        representatives_no_species = pd.DataFrame(columns=["SwissLipids_ID", "Representative_ID"])
+        if len(no_species) > 0:
+            representatives_no_species = GetRepresentativesNoSpeciesBatch(no_species=no_species,
+                                                                          graph=g,
+                                                                          levels=levels_data,
+                                                                          summary=no_species_summary)
+
+        memo = pd.concat([memo,
+                          representatives.assign(Status="one"),
+                          pd.DataFrame({"SwissLipids_ID": more_species, "Status": "more"}),
+                          representatives_no_species.assign(Status="none")])
+        memo = memo.drop_duplicates("SwissLipids_ID")[REPRESENTATIVES_MEMO_COLUMNS]
+        SaveRepresentativesMemo(memo, memo_dir)
+
+    # Object keys, so empty tables (float64 columns) merge as well
+    statuses = pd.merge(swl_ids[["SwissLipids_ID"]].astype(object),
+                        memo.astype({"SwissLipids_ID": object}), how="left")
+    representatives = statuses.loc[statuses.Status == "one", ["SwissLipids_ID", "Representative_ID"]]
+    more_species = statuses.SwissLipids_ID[statuses.Status == "more"]
+    no_species = statuses.loc[statuses.Status == "none", ["SwissLipids_ID", "Representative_ID"]]
+
+    # Compressing results:
+    print("...Compressing results...")
+    if len(getting_error) > 0:
+        print("Something went wrong. We got KeyError")
+
+    elif len(more_species) > 0:
+        print("Something went wrong. We got too many species")
+
+    elif len(no_species) > 0:
+        representatives = pd.concat([representatives, no_species])
+
+    representatives = representatives.drop_duplicates()
+    representatives = representatives.reset_index(drop=True)
+    repr_to_swl = representatives
+    return repr_to_swl
+    # # Merging results with data
+    # print("...Merging results with data...")
+    # representatives = pd.merge(representatives, data, how="left")
+    # representatives = representatives[["Representative_ID", "Lipid_ID"]]
+    # representatives = representatives.drop_duplicates()
+    # representatives = representatives.reset_index(drop=True)
+    #
+    # representatives = GetRepresentativesClasses(representatives)
+    #
+    # # Auto curation check
+    # print("...Auto check results from curation...")
+    # if check_annotation and curation is not None:
+    #     representatives = CheckAnnotation(representatives, curation)
+    #
+    # data = data[["Lipid_ID", "Formula", "Modification", "MZ"]]
+    # data = data.drop_duplicates()
+    # data = data.reset_index(drop=True)
+    #
+    # representatives = pd.merge(representatives, data, how="left")
+    # representatives = representatives.drop_duplicates()
+    # representatives = representatives.reset_index(drop=True)
+    #
+    # return representatives, repr_to_swl
+
+
+def CompileReferenceState(backend="networkx"):
+    # Everything GetRepresentatives and MappingToGraph compile from the
+    # reference files, for processes which run them many times
+    levels_data = GetReferenceTable("levels")
+    if backend == "snapshot":
+        graph = LoadGraphSnapshot()
+    else:
+        graph = CreateAnnotatedGraph(levels_data, backend=backend)
+
+    acyclic = GetReferenceTable("acyclic")
+    keys = [column for column in INHERITANCE_COLUMNS if column in acyclic.columns]
+    closure = None
+    if set(keys) <= set(PARENT_COLUMNS):
+        closure = CompileAncestorClosure(acyclic, keys)
+
+    return {"graph": graph,
+            "summary": CompileSpeciesSummary(graph),
+            "no_species_summary": CompileReachableSummary(graph, seeds=GetLevelSeeds(levels_data)),
+            "closure": closure}
+
+
+def SelectRepresentatives(data, repr_to_swl, curation=None):
+    # Lipid -> representative pairs, optionally checked against the curation
+    representatives = pd.merge(repr_to_swl, data, how="left")
+    representatives = representatives[["Representative_ID", "Lipid_ID"]]
+    representatives = representatives.drop_duplicates()
+    representatives = representatives.reset_index(drop=True)
+
+    representatives.columns = ["SwissLipids_ID", "Lipid_ID"]
+
+    if curation is not None:
+        print("...Auto check results from curation...")
+        representatives = CheckAnnotationBatch(representatives, curation)
+
+    representatives = representatives[["Lipid_ID", "SwissLipids_ID"]]
+    return representatives
+
+
+def GetRepresentativesNoSpecies(no_species, graph, levels):
+    representatives_no_species = pd.DataFrame(columns=["SwissLipids_ID", "Representative_ID"])
+
+    for lipid in no_species:
+        dfs_swl_ids = GetParentsWithLevels(graph=graph, levels=levels, source=lipid)
+        df = dfs_swl_ids[(dfs_swl_ids.Level != "Class") &
+                         (dfs_swl_ids.Level != "Category") &
+                         (dfs_swl_ids.Level != "-")]
+        if len(df) == 1:
+            df = df.reset_index(drop=True)
+            repr_id = df.SwissLipids_ID.iloc[0]
+            representatives_no_species = representatives_no_species.append({"SwissLipids_ID": lipid,
+                                                                            "Representative_ID": repr_id},
+                                                                           ignore_index=True)
+        else:
+            representatives_no_species = representatives_no_species.append({"SwissLipids_ID": lipid,
+                                                                            "Representative_ID": lipid},
+                                                                           ignore_index=True)
+    return representatives_no_species
+
+
+def GetRepresentativesNoSpeciesBatch(no_species, graph, levels, summary=None):
+    # One reachability summary over the non-Class/non-Category levels
+    # answers every lipid at once
+    if summary is None:
+        summary = CompileReachableSummary(graph, seeds=GetLevelSeeds(levels))
+
+    representatives = []
+    for lipid in no_species:
+        status, repr_id = summary.get(lipid, ("none", None))
+        representatives.append(repr_id if status == "one" else lipid)
+
+    representatives_no_species = pd.DataFrame({"SwissLipids_ID": list(no_species),
+                                               "Representative_ID": representatives},
+                                              columns=["SwissLipids_ID", "Representative_ID"])
+    return representatives_no_species
+
+
+def GetLevelSeeds(levels):
+    levels = levels[levels.Level.notnull() &
+                    (levels.Level != "Class") &
+                    (levels.Level != "Category") &
+                    (levels.Level != "-")]
+    counts = levels.SwissLipids_ID.value_counts()
+    counts = counts[counts > 0]
+    return {swl_id: ("one", swl_id) if count == 1 else ("more", None)
+            for swl_id, count in counts.items()}
+
+
+def GetParentsWithLevels(graph, levels, source):
+    dfs_output = DFSPreorder(graph, source=source)
+    dfs_swl_ids = pd.DataFrame({"SwissLipids_ID": dfs_output})
+    dfs_swl_ids = pd.merge(dfs_swl_ids, levels, how="left",
+                           left_on="SwissLipids_ID", right_on="SwissLipids_ID")
+    dfs_swl_ids.loc[dfs_swl_ids["Level"].isnull(), "Level"] = "-"
+    return dfs_swl_ids
+
+
+@profiling.Profiled("run_dfs")
+def RunDFS(swl_ids, graph):
+    more_species = []
+    no_species = []
+    getting_error = []
+    representatives = pd.DataFrame(columns=["SwissLipids_ID", "Representative_ID"])
+
+    for i in range(len(swl_ids)):
+        if swl_ids.SwissLipids_ID[i] in graph.nodes():
+            try:
+                SG = [n for n in DFSPreorder(graph, source=swl_ids.SwissLipids_ID[i])
+                      if graph.nodes[n]["Level"] == "Species"]
+
+            except KeyError:
+                getting_error.append(swl_ids.SwissLipids_ID[i])
+
+            if len(SG) > 1:
+                more_species.append(swl_ids.SwissLipids_ID[i])
+
+            elif len(SG) < 1:
+                no_species.append(swl_ids.SwissLipids_ID[i])
+
+            elif len(SG) == 1:
+                repr_id = SG[0]
+                representatives = representatives.append({"SwissLipids_ID": swl_ids.SwissLipids_ID[i],
+                                                          "Representative_ID": repr_id},
+                                                         ignore_index=True)
+        else:
+            no_species.append(swl_ids.SwissLipids_ID[i])
+
+    return representatives, more_species, no_species, getting_error
+
+'''
+    The graph is compiled once into a per-node summary of the reachable
+    "Species" nodes: ("none", None), ("one", Species_ID), ("more", None),
+    or ("error", None) when a reachable node has no level
+'''
+
+
+def CompileSpeciesSummary(graph):
+    return CompileReachableSummary(graph, seeds=GetSpeciesSeeds(graph))
+
+
+def GetSpeciesSeeds(graph):
+    if isinstance(graph, CSRGraph):
+        return {node: ("one", node) for node in graph.ids[np.asarray(graph.levels == "Species")]}
+
+    seeds = {}
+    for node, attributes in graph.nodes(data=True):
+        if "Level" not in attributes:
+            seeds[node] = ("error", None)
+        elif attributes["Level"] == "Species":
+            seeds[node] = ("one", node)
+    return seeds
+
+
+@profiling.Profiled("reachable_summary")
+def CompileReachableSummary(graph, seeds):
+    profiling.Count("graph_nodes_visited", len(graph))
+    if isinstance(graph, CSRGraph):
+        return CompileCSRReachableSummary(graph, seeds)
+
+    # Strongly connected components keep the dynamic program correct on cycles
+    condensed = nx.condensation(graph)
+    summary = {}
+
+    for component in reversed(list(nx.topological_sort(condensed))):
+        value = ("none", None)
+        for node in condensed.nodes[component]["members"]:
+            value = MergeReachableSummary(value, seeds.get(node, ("none", None)))
+        for successor in condensed.successors(component):
+            value = MergeReachableSummary(value, summary[successor])
+        summary[component] = value
+
+    return {node: summary[component] for node, component in condensed.graph["mapping"].items()}
+
+
+def MergeReachableSummary(a, b):
+    if a[0] == "error" or b[0] == "error":
+        return ("error", None)
+    if a[0] == "none":
+        return b
+    if b[0] == "none":
+        return a
+    if a[0] == "one" and b[0] == "one" and a[1] == b[1]:
+        return a
+    return ("more", None)
+
+
+def ResolveRepresentatives(swl_ids, summary):
+    more_species = []
+    no_species = []
+    getting_error = []
+    representatives_swl = []
+    representatives_repr = []
+
+    for swl_id in swl_ids.SwissLipids_ID:
+        status, repr_id = summary.get(swl_id, ("none", None))
+
+        if status == "error":
+            getting_error.append(swl_id)
+
+        elif status == "more":
+            more_species.append(swl_id)
+
+        elif status == "none":
+            no_species.append(swl_id)
+
+        else:
+            representatives_swl.append(swl_id)
+            representatives_repr.append(repr_id)
+
+    representatives = pd.DataFrame({"SwissLipids_ID": representatives_swl,
+                                    "Representative_ID": representatives_repr},
+                                   columns=["SwissLipids_ID", "Representative_ID"])
+    return representatives, more_species, no_species, getting_error
+
+
+def CreateAnnotatedGraph(levels_data, backend="networkx"):
+    file = "data/graph.txt"
+    if backend == "csr":
+        return CreateAnnotatedCSRGraph(levels_data, file=file)
+
+    n, m, edges_list = GetData(file)
+
+    # Creating graph
+    print("\n..Creating Graph..")
+    g = MakeGraph(n, edges_list)
+
+    # Annotating graph
+    g_ann = pd.DataFrame({"SwissLipids_ID": list(g.nodes())})
+    levels_data = pd.merge(g_ann, levels_data, how="left",
+                           left_on="SwissLipids_ID", right_on="SwissLipids_ID")
+    levels_data.loc[levels_data["Level"].isnull(), "Level"] = "-"
+    g = AnnotateGraph(g, levels=levels_data)
+
+    return g
+
+
+def AddingLevelsToData(data, levels_data):
+    swl_ids = data.SwissLipids_ID.drop_duplicates().values
+    swl_ids = pd.DataFrame({"SwissLipids_ID": list(swl_ids)})
+    swl_ids = pd.merge(swl_ids, levels_data, how="left")
+    swl_ids.loc[swl_ids["Level"].isnull(), "Level"] = "-"
+    return swl_ids
+
+
+def AnnotateGraph(g, levels):
+    node_attr = levels.set_index('SwissLipids_ID').to_dict('index')
+    nx.set_node_attributes(g, node_attr)
+    return g
+
+
+def MakeGraph(n, edges_list):
+    g = nx.DiGraph()
+    for edge in edges_list:
+        try:
+            g.add_edge(edge[0], edge[1])
+        except IndexError:
+            print(edge)
+    return g
+
+
+def ReadFile(file):
+    with open(file, 'r') as f:
+        n = int(f.readline())
+        m = int(f.readline())
+        arr = ReadList(f.readline())
+        keys = ReadList(f.readline())
+    return n, m, arr, keys
+
+
+def ReadList(s):
+    return list(map(str, s.split()))
+
+
+@profiling.Profiled("read_graph")
+def GetData(file):
+    edges_list = []
+
+    with open(file, "r") as f:
+        n, m = map(int, f.readline().split())
+
+        for i in range(m):
+            edges_list.append(ReadList(f.readline()))
+
+    return n, m, edges_list
+
+'''
+    Compact graph backend: node IDs are interned to int32 codes, edges are
+    stored as CSR arrays and levels as a categorical array aligned with the codes
+'''
+
+
+class CSRGraph:
+
+    def __init__(self, ids, indptr, indices, levels):
+        self.ids = ids
+        self.index = pd.Index(ids)
+        self.indptr = indptr
+        self.indices = indices
+        self.levels = levels
+        self.nodes = CSRNodeView(self)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def successors(self, code):
+        return self.indices[self.indptr[code]:self.indptr[code + 1]]
+
+    def dfs_preorder(self, source):
+        # Same visiting order as nx.dfs_preorder_nodes
+        start = self.index.get_loc(source)
+        visited = {start}
+        order = [start]
+        stack = [(start, self.indptr[start])]
+
+        while stack:
+            code, position = stack[-1]
+            if position == self.indptr[code + 1]:
+                stack.pop()
+                continue
+            stack[-1] = (code, position + 1)
+            child = self.indices[position]
+            if child not in visited:
+                visited.add(child)
+                order.append(child)
+                stack.append((child, self.indptr[child]))
+
+        return order
+
+    def to_networkx(self):
+        g = nx.DiGraph()
+        g.add_nodes_from(self.ids)
+        sources = np.repeat(np.arange(len(self.ids)), np.diff(self.indptr))
+        g.add_edges_from(zip(self.ids[sources], self.ids[self.indices]))
+        nx.set_node_attributes(g, {node: {"Level": level} for node, level in zip(self.ids, self.levels)})
+        return g
+
+
+class CSRNodeView:
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __call__(self):
+        return self
+
+    def __contains__(self, node):
+        return node in self.graph.index
+
+    def __iter__(self):
+        return iter(self.graph.ids)
+
+    def __len__(self):
+        return len(self.graph.ids)
+
+    def __getitem__(self, node):
+        return {"Level": self.graph.levels[self.graph.index.get_loc(node)]}
+
+
+def CreateAnnotatedCSRGraph(levels_data, file="data/graph.txt"):
+    n, m, sources, targets = GetDataArrays(file)
+
+    # Creating graph
+    print("\n..Creating CSR Graph..")
+    g = MakeCSRGraph(sources, targets)
+
+    # Annotating graph
+    g.levels = GetCSRLevels(g.ids, levels_data)
+
+    return g
+
+
+@profiling.Profiled("read_graph")
+def GetDataArrays(file):
+    with open(file, "r") as f:
+        n, m = map(int, f.readline().split())
+
+    edges = pd.read_csv(file, sep=r"\s+", header=None, skiprows=1, nrows=m,
+                        names=["Source", "Target"], dtype=str)
+    broken = edges.Target.isnull()
+    if broken.any():
+        print(edges[broken])
+        edges = edges[~broken]
+
+    return n, m, edges.Source.values, edges.Target.values
+
+
+def MakeCSRGraph(sources, targets):
+    # Interning in order of first appearance, like nx.DiGraph.add_edge
+    codes, ids = pd.factorize(np.column_stack([sources, targets]).ravel())
+    ids = np.asarray(ids, dtype=object)
+    codes = codes.astype(np.int32).reshape(-1, 2)
+    sources, targets = codes[:, 0], codes[:, 1]
+
+    # Dropping repeated edges, keeping the first occurrence
+    keys = sources.astype(np.int64) * len(ids) + targets
+    _, first = np.unique(keys, return_index=True)
+    first = np.sort(first)
+    sources, targets = sources[first], targets[first]
+
+    order = np.argsort(sources, kind="stable")
+    indices = targets[order]
+    indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=len(ids)), out=indptr[1:])
+
+    levels = pd.Categorical(np.full(len(ids), "-", dtype=object))
+    return CSRGraph(ids, indptr, indices, levels)
+
+
+def GetCSRLevels(ids, levels_data):
+    levels = levels_data.drop_duplicates(subset=["SwissLipids_ID"], keep="last")
+    levels = levels.set_index("SwissLipids_ID").Level
+    levels = pd.Series(ids).map(levels)
+    levels[levels.isnull()] = "-"
+    return pd.Categorical(levels.values)
+
+
+def DFSPreorder(graph, source):
+    if isinstance(graph, CSRGraph):
+        nodes = list(graph.ids[graph.dfs_preorder(source)])
+    else:
+        nodes = list(nx.dfs_preorder_nodes(graph, source=source))
+    profiling.Count("graph_nodes_visited", len(nodes))
+    return nodes
+
+
+def CompileCSRReachableSummary(graph, seeds):
+    # Kahn's algorithm on the reversed edges: a node is resolved once all of
+    # its successors are
+    size = len(graph)
+    out_degree = np.diff(graph.indptr)
+    sources = np.repeat(np.arange(size), out_degree)
+    order = np.argsort(graph.indices, kind="stable")
+    predecessors = sources[order]
+    predecessors_indptr = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(graph.indices, minlength=size), out=predecessors_indptr[1:])
+
+    seed_values = [("none", None)] * size
+    seed_nodes = list(seeds.keys())
+    for node, code in zip(seed_nodes, graph.index.get_indexer(seed_nodes)):
+        if code >= 0:
+            seed_values[code] = seeds[node]
+
+    summary = [None] * size
+    remaining = out_degree.copy()
+    queue = list(np.flatnonzero(remaining == 0))
+
+    while queue:
+        code = queue.pop()
+        value = seed_values[code]
+        for successor in graph.successors(code):
+            value = MergeReachableSummary(value, summary[successor])
+        summary[code] = value
+        for predecessor in predecessors[predecessors_indptr[code]:predecessors_indptr[code + 1]]:
+            remaining[predecessor] -= 1
+            if remaining[predecessor] == 0:
+                queue.append(predecessor)
+
+    if any(value is None for value in summary):
+        # Cycles in the hierarchy, falling back to the condensation
+        return CompileReachableSummary(graph.to_networkx(), seeds)
+
+    return dict(zip(graph.ids, summary))
+
+
+'''
+    Binary snapshot of the CSR graph: the node table, the edge arrays and the
+    level codes are written once as .npy files and memory-mapped back, keyed by
+    the checksums of graph.txt and levels_data.csv
+'''
+
+GRAPH_SNAPSHOT_VERSION = 1
+GRAPH_SNAPSHOT_ARRAYS = ["ids", "indptr", "indices", "level_codes"]
+
+
+def LoadGraphSnapshot(graph_file="data/graph.txt", levels_file="data/levels_data.csv",
+                      cache_dir="cache/graph"):
+    key = GetGraphSnapshotKey(graph_file, levels_file)
+    path = os.path.join(cache_dir, key)
+
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        print("...Compiling graph snapshot...")
+        CompileGraphSnapshot(graph_file, levels_file, path)
+
+    print("...Loading graph snapshot...")
+    return ReadGraphSnapshot(path)
+
+
+def GetGraphSnapshotKey(graph_file, levels_file):
+    key = json.dumps({"version": GRAPH_SNAPSHOT_VERSION,
+                      "files": GetChecksums([graph_file, levels_file])}, sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def CompileGraphSnapshot(graph_file, levels_file, path):
+    levels_data = pd.read_csv(levels_file, sep=",")
+    levels_data.columns = ["SwissLipids_ID", "Level"]
+
+    n, m, sources, targets = GetDataArrays(graph_file)
+    g = MakeCSRGraph(sources, targets)
+    g.levels = GetCSRLevels(g.ids, levels_data)
+
+    tmp_path = "%s.tmp%d" % (path, os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+
+    np.save(os.path.join(tmp_path, "ids.npy"), g.ids.astype(str))
+    np.save(os.path.join(tmp_path, "indptr.npy"), g.indptr)
+    np.save(os.path.join(tmp_path, "indices.npy"), g.indices)
+    np.save(os.path.join(tmp_path, "level_codes.npy"), g.levels.codes)
+
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({"version": GRAPH_SNAPSHOT_VERSION,
+                   "files": GetChecksums([graph_file, levels_file]),
+                   "levels": list(g.levels.categories)}, f)
+
+    CommitCacheDirectory(tmp_path, path)
+
+
+def ReadGraphSnapshot(path):
+    with open(os.path.join(path, "meta.json"), "r") as f:
+        meta = json.load(f)
+
+    arrays = {array: np.load(os.path.join(path, "%s.npy" % array), mmap_mode="r")
+              for array in GRAPH_SNAPSHOT_ARRAYS}
+    levels = pd.Categorical.from_codes(arrays["level_codes"], categories=meta["levels"])
+
+    return CSRGraph(arrays["ids"], arrays["indptr"], arrays["indices"], levels)
+
+
+'''
+    Memo of the representatives: the status (one/more/none) and the
+    representative of every SwissLipids ID resolved so far, shared across
+    runs and datasets. It is tagged with the graph snapshot key, so it is
+    rebuilt whenever graph.txt or levels_data.csv changes
+'''
+
+REPRESENTATIVES_MEMO_COLUMNS = ["SwissLipids_ID", "Status", "Representative_ID"]
+
+
+def LoadRepresentativesMemo(memo_dir="cache/representatives"):
+    path = GetRepresentativesMemoPath(memo_dir)
+    if path is None or not os.path.exists(path):
+        return pd.DataFrame(columns=REPRESENTATIVES_MEMO_COLUMNS)
+
+    print("...Loading memoized representatives...")
+    return ReadTable(path)
+
+
+def SaveRepresentativesMemo(memo, memo_dir="cache/representatives"):
+    path = GetRepresentativesMemoPath(memo_dir)
+    if path is None:
+        return
+
+    os.makedirs(memo_dir, exist_ok=True)
+    with FileLock(path):
+        # Statuses saved by other runs since this one loaded the memo are kept
+        if os.path.exists(path):
+            memo = pd.concat([ReadTable(path), memo])
+        memo = memo.drop_duplicates("SwissLipids_ID")[REPRESENTATIVES_MEMO_COLUMNS]
+
+        tmp_path = "%s.tmp%d.%s" % (path, os.getpid(), GetTableFormat(path))
+        WriteTable(memo.reset_index(drop=True), tmp_path)
+        os.replace(tmp_path, path)
+
+
+def GetRepresentativesMemoPath(memo_dir):
+    if memo_dir is None:
+        return None
+    key = GetGraphSnapshotKey("data/graph.txt", "data/levels_data.csv")
+    return os.path.join(memo_dir, "%s.%s" % (key, GetDefaultTableFormat()))
@@ -0,0 +1,170 @@
+import pandas as pd
+import numpy as np
+import os
+import time
+import shutil
+import hashlib
+import contextlib
+import profiling
+
+
+''' 
+    This part is dedicated to storing intermediate results
+'''
+
+# ID columns are dictionary-encoded in Parquet files
+ID_COLUMNS = ["Lipid_ID", "SwissLipids_ID", "Representative_ID", "Initial_SwissLipids_ID",
+              "ChEBI_ID", "Level", "Formula", "Modification"]
+
+_CHECKSUMS = {}
+
+# Seconds after which a lock file is taken to be left over by a crashed process
+LOCK_TIMEOUT = 600
+
+
+def GetDefaultTableFormat():
+    try:
+        import pyarrow
+    except ImportError:
+        return "csv"
+    return "parquet"
+
+
+def GetTableFormat(path):
+    return "csv" if path.endswith(".csv") else "parquet"
+
+
+@profiling.Profiled("write_table")
+def WriteTable(data, path):
+    if GetTableFormat(path) == "csv":
+        data.to_csv(path, index=False)
+        return
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    pq.write_table(table, path,
+                   use_dictionary=[column for column in data.columns if column in ID_COLUMNS])
+
+
+@profiling.Profiled("read_table")
+def ReadTable(path, columns=None, categorical=False, memory_map=True):
+    if GetTableFormat(path) == "csv":
+        # Floats are read back exactly as they were written
+        return pd.read_csv(path, sep=",", usecols=columns, float_precision="round_trip")
+
+    import pyarrow.parquet as pq
+
+    schema = pq.read_schema(path)
+    read_dictionary = None
+    if categorical:
+        read_dictionary = [column for column in schema.names if column in ID_COLUMNS]
+
+    table = pq.read_table(path, columns=columns, memory_map=memory_map,
+                          read_dictionary=read_dictionary)
+    return table.to_pandas()
+
+
+def GetChecksums(files):
+    checksums = {}
+    for file in sorted(files):
+        checksums[os.path.basename(file)] = GetChecksum(file)
+    return checksums
+
+
+def GetChecksum(file):
+    # Every file is read once per process while its size and mtime stay the same
+    stat = os.stat(file)
+    key = (os.path.abspath(file), stat.st_size, stat.st_mtime_ns)
+    if key not in _CHECKSUMS:
+        md5 = hashlib.md5()
+        with open(file, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                md5.update(chunk)
+        _CHECKSUMS[key] = md5.hexdigest()
+    return _CHECKSUMS[key]
+
+
+def CommitCacheDirectory(tmp_path, path):
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # Another process has already written the same cache
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def FileLock(path, timeout=LOCK_TIMEOUT):
+    # "<path>.lock" is created by one process at a time
+    lock_path = "%s.lock" % path
+    while True:
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > timeout:
+                    os.remove(lock_path)
+                    continue
+            except OSError:
+                continue
+            time.sleep(0.05)
+
+    try:
+        yield
+    finally:
+        os.remove(lock_path)
+
+
+@profiling.Profiled("write_table")
+def WriteTableChunks(chunks, path, dtypes):
+    if GetTableFormat(path) == "csv":
+        header = True
+        for chunk in chunks:
+            chunk.to_csv(path, index=False, header=header, mode="w" if header else "a")
+            header = False
+        if header:
+            pd.DataFrame(columns=list(dtypes)).to_csv(path, index=False)
+        return
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # "dtypes" fixes the columns and their order. Their types come from the
+    # first chunk with rows, so e.g. integer Lipid_IDs stay integers
+    writer = None
+    try:
+        for chunk in chunks:
+            chunk = chunk[list(dtypes)]
+            if len(chunk) == 0:
+                continue
+            if writer is None:
+                schema = GetChunkSchema(chunk, dtypes)
+                writer = pq.ParquetWriter(path, schema,
+                                          use_dictionary=[column for column in dtypes if column in ID_COLUMNS])
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+        if writer is None:
+            writer = pq.ParquetWriter(path, GetChunkSchema(None, dtypes),
+                                      use_dictionary=[column for column in dtypes if column in ID_COLUMNS])
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def GetChunkSchema(chunk, dtypes):
+    # Columns without values in "chunk" (or no chunk at all) take their type from "dtypes"
+    import pyarrow as pa
+
+    inferred = {}
+    if chunk is not None:
+        inferred = {field.name: field.type for field in pa.Schema.from_pandas(chunk, preserve_index=False)}
+
+    fields = []
+    for column, dtype in dtypes.items():
+        field_type = inferred.get(column)
+        if field_type is None or pa.types.is_null(field_type):
+            field_type = pa.string() if dtype == "string" else pa.from_numpy_dtype(np.dtype(dtype))
+        fields.append((column, field_type))
+    return pa.schema(fields)
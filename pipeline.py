@@ -0,0 +1,396 @@
+import os
+import json
+import hashlib
+import argparse
+import pandas as pd
+import profiling
+import lipid_preprocessing as lp
+
+
+'''
+    End-to-end pipeline:
+    annotation -> representatives -> selection -> back mapping -> ChEBI mapping -> merge
+
+    Every stage output is stored under cache/pipeline/<stage>/<key>.parquet
+    (or .csv when pyarrow is not installed), where the key hashes the stage
+    parameters and the content of its inputs (input files and upstream stage
+    outputs), so a rerun only recomputes the stages whose inputs changed.
+
+    chunksize only bounds the memory of the annotation stage, whose candidates
+    are streamed into the cache file. The feature table is still read whole,
+    and the later stages load the full annotation back. Use --annotate-only
+    to stream the annotation alone, with memory bounded by the chunk size
+'''
+
+PIPELINE_VERSION = 1
+
+REPRESENTATIVES_FILES = ["data/levels_data.csv", "data/graph.txt"]
+CURATION_FILES = ["data/full_classes_data_LM_SWL.csv"]
+CHEBI_MAPPING_FILES = ["data/levels_data.csv",
+                       "data/lipidmaps_to_chebi_to_pubchem_to_swisslipids.csv",
+                       "data/acyclic_graph.csv"]
+
+FEATURE_COLUMNS = ["Lipid_ID", "Lipid_class", "Bulk_structure",
+                   "Detailed_structure", "Adduct", "Index_Othermode", "MZ", "RT"]
+
+
+@profiling.Profiled("pipeline")
+def RunPipeline(features_file="data/newTL_4sp.txt", modes_file="data/pos_neg_mode.csv",
+                curation_file=None, output_file="results/annotated_data_final.csv",
+                cache_dir="cache/pipeline", n_jobs=1, backend="networkx", table_format=None,
+                chunksize=None, tolerance=None, max_error=None, top_k=None, scores=False,
+                group=False, mz_tolerance=0.0, rt_tolerance=None, link_modes=False,
+                incremental_dir=None, matrix_file=None, intensities_file=None, propagated_file=None,
+                aggregations=None):
+    if table_format is None:
+        table_format = lp.GetDefaultTableFormat()
+
+    features = ReadFeatureTable(features_file, modes_file)
+    features_hash = HashFiles([features_file, modes_file])
+
+    # Annotating data with LIPYD, streamed from the feature table into the stage
+    # cache if chunksize is given (the later stages read the whole annotation)
+    options = {"tolerance": tolerance, "max_error": max_error, "top_k": top_k, "scores": scores}
+    annotate = lambda: lp.AnnotateDataWithLipyd(data=features[["Lipid_ID", "MZ", "Mode"]],
+                                                adducts=features[["Lipid_ID", "Adduct"]],
+                                                n_jobs=n_jobs, **options)
+
+    # Only new or changed features are annotated when an incremental store is given
+    if incremental_dir is not None:
+        annotate = lambda: lp.AnnotateDataIncremental(data=features[["Lipid_ID", "MZ", "Mode"]],
+                                                      adducts=features[["Lipid_ID", "Adduct"]],
+                                                      store_dir=incremental_dir, table_format=table_format,
+                                                      n_jobs=n_jobs, **options)
+
+    # Grouping duplicated features needs the whole table, so it replaces streaming
+    grouping = None
+    if group:
+        grouping = {"mz_tolerance": mz_tolerance, "rt_tolerance": rt_tolerance, "link_modes": link_modes}
+        annotate = lambda: lp.AnnotateGroupedFeatures(
+            data=features[["Lipid_ID", "MZ", "Mode", "RT", "Index_Othermode"]],
+            adducts=features[["Lipid_ID", "Adduct"]], n_jobs=n_jobs, **grouping, **options)
+
+    write = None
+    if chunksize is not None and not group and incremental_dir is None:
+        write = lambda path: lp.AnnotateDataWithLipydStreaming(
+            ReadFeatureTableChunks(features_file, modes_file, chunksize), path, **options)
+
+    annotated_data, annotated_hash = RunStage(
+        "annotation",
+        annotate,
+        inputs={"features": features_hash,
+                "database": HashFiles(lp.GetDatabaseFiles(download=True))},
+        params={"options": options, "grouping": grouping},
+        cache_dir=cache_dir,
+        table_format=table_format,
+        write=write)
+
+    # Getting representatives, reusing the stored ones of known SwissLipids IDs
+    get_representatives = lambda: lp.GetRepresentatives(data=annotated_data, backend=backend)
+    if incremental_dir is not None:
+        get_representatives = lambda: lp.GetRepresentativesIncremental(data=annotated_data,
+                                                                       store_dir=incremental_dir,
+                                                                       backend=backend)
+
+    repr_to_swl, repr_to_swl_hash = RunStage(
+        "representatives",
+        get_representatives,
+        inputs={"annotation": annotated_hash,
+                "reference": HashFiles(REPRESENTATIVES_FILES)},
+        params={},
+        cache_dir=cache_dir,
+        table_format=table_format)
+
+    # Selecting representatives of every lipid, checked against the curation
+    curation = None
+    curation_hash = None
+    if curation_file is not None:
+        curation = pd.read_csv(curation_file, sep=",")
+        curation.columns = ["Lipid_ID", "Curation"]
+        curation_hash = HashFiles([curation_file] + CURATION_FILES)
+
+    representatives, representatives_hash = RunStage(
+        "selection",
+        lambda: lp.SelectRepresentatives(annotated_data, repr_to_swl, curation=curation),
+        inputs={"annotation": annotated_hash,
+                "representatives": repr_to_swl_hash,
+                "curation": curation_hash},
+        params={},
+        cache_dir=cache_dir,
+        table_format=table_format)
+
+    # Go back from representatives to lipids
+    back_mapped, back_mapped_hash = RunStage(
+        "back_mapping",
+        lambda: lp.RepresentativesToLipids(representatives, repr_to_swl),
+        inputs={"selection": representatives_hash,
+                "representatives": repr_to_swl_hash},
+        params={},
+        cache_dir=cache_dir,
+        table_format=table_format)
+
+    # Mapping to graph
+    annotated_chebi, annotated_chebi_hash = RunStage(
+        "chebi_mapping",
+        lambda: lp.MappingToGraph(back_mapped),
+        inputs={"back_mapping": back_mapped_hash,
+                "reference": HashFiles(CHEBI_MAPPING_FILES)},
+        params={},
+        cache_dir=cache_dir,
+        table_format=table_format)
+
+    # Merging everything back
+    result, _ = RunStage(
+        "merge",
+        lambda: MergeWithFeatures(annotated_chebi, features),
+        inputs={"chebi_mapping": annotated_chebi_hash,
+                "features": features_hash},
+        params={},
+        cache_dir=cache_dir,
+        table_format=table_format)
+
+    if output_file is not None:
+        os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+        lp.WriteTable(result, output_file)
+
+    # Feature x ChEBI matrix, rows in the order of the feature table
+    if matrix_file is not None:
+        matrix, rows, columns = lp.BuildIncidenceMatrix(annotated_chebi, lipid_ids=features.Lipid_ID)
+        lp.WriteIncidenceMatrix(matrix, rows, columns, matrix_file, table_format=table_format)
+
+    # Sample values aggregated to every reached ChEBI ID
+    if intensities_file is not None and propagated_file is not None:
+        propagated = lp.PropagateToOntology(annotated_chebi, ReadIntensityTable(intensities_file),
+                                            aggregations=aggregations)
+        lp.WritePropagatedValues(propagated, propagated_file)
+
+    return result
+
+
+def RunBatch(datasets, output_dir="results/batch", n_jobs=1, backend="networkx", table_format="csv",
+             tolerance=None, max_error=None, top_k=None):
+    # "datasets" maps a dataset name to its (features_file, modes_file)
+    features = {name: ReadFeatureTable(features_file, modes_file)
+                for name, (features_file, modes_file) in datasets.items()}
+
+    # Every distinct (m/z, mode, adduct) key of all datasets is annotated once
+    keys = pd.concat([data[["MZ", "Mode", "Adduct"]] for data in features.values()])
+    keys = keys.drop_duplicates().reset_index(drop=True)
+    keys["Key"] = ["K%d" % i for i in range(len(keys))]
+
+    print("...Annotating %d distinct keys of %d features in %d datasets..." %
+          (len(keys), sum(len(data) for data in features.values()), len(features)))
+    annotation = lp.AnnotateDataWithLipyd(data=keys[["Key", "MZ", "Mode"]].rename(columns={"Key": "Lipid_ID"}),
+                                          adducts=keys[["Key", "Adduct"]].rename(columns={"Key": "Lipid_ID"}),
+                                          n_jobs=n_jobs, tolerance=tolerance, max_error=max_error, top_k=top_k)
+
+    # The graph, its summaries and the ChEBI closure are shared by all datasets
+    state = lp.CompileReferenceState(backend=backend)
+
+    os.makedirs(output_dir, exist_ok=True)
+    results = {}
+    for name, data in features.items():
+        print("...Dataset %s..." % name)
+        groups = pd.merge(data[["Lipid_ID", "MZ", "Mode", "Adduct"]], keys, how="left")
+        groups = pd.DataFrame({"Lipid_ID": groups.Lipid_ID,
+                               "Group": groups.Key,
+                               "Representative": groups.Key})
+        annotated_data = lp.FanOutAnnotation(annotation[annotation.Lipid_ID.isin(groups.Representative)],
+                                             groups, data)
+
+        # Representatives are resolved per dataset, as in a single run
+        repr_to_swl = lp.GetRepresentatives(data=annotated_data, backend=backend, graph=state["graph"],
+                                            summary=state["summary"],
+                                            no_species_summary=state["no_species_summary"])
+        representatives = lp.SelectRepresentatives(annotated_data, repr_to_swl)
+        back_mapped = lp.RepresentativesToLipids(representatives, repr_to_swl)
+        annotated_chebi = lp.MappingToGraph(back_mapped, closure=state["closure"])
+
+        results[name] = MergeWithFeatures(annotated_chebi, data)
+        lp.WriteTable(results[name], os.path.join(output_dir, "%s.%s" % (name, table_format)))
+
+    return results
+
+
+def ReadBatchManifest(manifest_file):
+    # CSV with Name, Features, Modes columns, one dataset per row
+    manifest = pd.read_csv(manifest_file, sep=",")
+    return {name: (features_file, modes_file)
+            for name, features_file, modes_file in zip(manifest.Name, manifest.Features, manifest.Modes)}
+
+
+def ReadFeatureTable(features_file, modes_file):
+    features = pd.read_csv(features_file, sep='\t')
+
+    # Renaming columns
+    features.columns = FEATURE_COLUMNS
+
+    # Replacing adducts with supported form
+    features.loc[features["Adduct"] == "M-H+FA", "Adduct"] = "M+HCOO"
+
+    # Adding info on modes of the features
+    pos_neg_data = pd.read_csv(modes_file, sep='\t')
+    features = pd.merge(features, pos_neg_data, how="left")
+
+    return features
+
+
+def ReadIntensityTable(intensities_file):
+    # Lipid_ID in the first column, one column per sample
+    intensities = pd.read_csv(intensities_file, sep='\t', index_col=0)
+    intensities.index = intensities.index.astype(str)
+    intensities.index.name = "Lipid_ID"
+    return intensities
+
+
+def ReadFeatureTableChunks(features_file, modes_file, chunksize):
+    # Only the small Lipid_ID -> Mode table is kept in memory
+    pos_neg_data = pd.read_csv(modes_file, sep='\t')
+
+    def ReadChunks():
+        for features in pd.read_csv(features_file, sep='\t', chunksize=chunksize):
+            features.columns = FEATURE_COLUMNS
+            features.loc[features["Adduct"] == "M-H+FA", "Adduct"] = "M+HCOO"
+            yield pd.merge(features, pos_neg_data, how="left")
+
+    return ReadChunks
+
+
+def MergeWithFeatures(annotated_data, features):
+    result = pd.merge(annotated_data, features[FEATURE_COLUMNS], how="left")
+
+    result = result[["Lipid_ID", "Lipid_class", "Bulk_structure",
+                     "Detailed_structure", "Adduct", "Index_Othermode", "MZ", "RT",
+                     "ChEBI_ID", "SwissLipids_ID", "Level",
+                     "Initial_SwissLipids_ID", "Depth", "Representative_ID"]]
+
+    result.columns = ['index_newtable_4sp', 'Lipid class', 'Bulk structure',
+                      'Detailed structure', 'adduct', 'index_othermode_newtable_4sp',
+                      'newtable_4sp_mz', 'newtable_4sp_rt',
+                      "ChEBI_ID", "SwissLipids_ID", "Level",
+                      "Initial_SwissLipids_ID", "Depth", "Representative_ID"]
+    return result
+
+
+def RunStage(name, compute, inputs, params, cache_dir, table_format="csv", write=None):
+    key = GetStageKey(name, inputs, params)
+    path = os.path.join(cache_dir, name, "%s.%s" % (key, table_format))
+
+    with profiling.Stage("stage:%s" % name) as record:
+        if os.path.exists(path):
+            print("...Stage %s: using cached result..." % name)
+            record["cached"] = True
+        else:
+            print("...Stage %s: running..." % name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = "%s.tmp%d.%s" % (path, os.getpid(), table_format)
+
+            if write is not None:
+                write(tmp_path)
+            else:
+                lp.WriteTable(compute(), tmp_path)
+            os.replace(tmp_path, path)
+            record["cached"] = False
+
+        # Reading back, so cached and fresh runs hand over identical tables
+        result = lp.ReadTable(path)
+        record["rows_out"] = len(result)
+
+    return result, HashFiles([path])
+
+
+def GetStageKey(name, inputs, params):
+    key = json.dumps({"version": PIPELINE_VERSION,
+                      "stage": name,
+                      "inputs": inputs,
+                      "params": params}, sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def HashFiles(files):
+    key = json.dumps(lp.GetChecksums(files), sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lipid annotation and ChEBI mapping pipeline")
+    parser.add_argument("--features", default="data/newTL_4sp.txt")
+    parser.add_argument("--modes", default="data/pos_neg_mode.csv")
+    parser.add_argument("--curation", default=None,
+                        help="CSV with Lipid_ID, Curation columns")
+    parser.add_argument("--output", default="results/annotated_data_final.csv",
+                        help="Final table, written as CSV or Parquet by extension")
+    parser.add_argument("--cache-dir", default="cache/pipeline")
+    parser.add_argument("--n-jobs", type=int, default=1,
+                        help="Annotation worker processes, 0 or less for one per CPU")
+    parser.add_argument("--backend", default="networkx", choices=["networkx", "csr", "snapshot"])
+    parser.add_argument("--format", default=None, choices=["parquet", "csv"],
+                        help="Format of the cached stage outputs and of the --matrix index tables")
+    parser.add_argument("--chunksize", type=int, default=None,
+                        help="Stream the feature table through the annotation stage in chunks of this "
+                             "many rows. Only --annotate-only keeps the memory of the whole run bounded")
+    parser.add_argument("--annotate-only", action="store_true",
+                        help="Only stream the annotation of the feature table into --output")
+    parser.add_argument("--ppm", type=float, default=None,
+                        help="Mass tolerance of the annotation in ppm, the lipyd tolerance by default")
+    parser.add_argument("--max-error", type=float, default=None,
+                        help="Drop candidates with a larger absolute mass error (ppm)")
+    parser.add_argument("--top-k", type=int, default=None,
+                        help="Keep the k candidates with the smallest mass error per feature")
+    parser.add_argument("--scores", action="store_true",
+                        help="Add the Error_ppm and Rank columns to the annotation")
+    parser.add_argument("--group", action="store_true",
+                        help="Annotate groups of duplicated features once")
+    parser.add_argument("--group-ppm", type=float, default=0.0,
+                        help="m/z tolerance (ppm) of the feature groups")
+    parser.add_argument("--group-rt", type=float, default=None,
+                        help="RT tolerance of the feature groups")
+    parser.add_argument("--link-modes", action="store_true",
+                        help="Keep the candidates confirmed by the other-mode feature of Index_Othermode")
+    parser.add_argument("--incremental", default=None, metavar="STORE_DIR",
+                        help="Only annotate new or changed features, keeping the results in STORE_DIR")
+    parser.add_argument("--batch", default=None, metavar="MANIFEST",
+                        help="CSV with Name, Features, Modes columns: process all datasets together")
+    parser.add_argument("--output-dir", default="results/batch",
+                        help="Directory of the per-dataset outputs of --batch")
+    parser.add_argument("--matrix", default=None, metavar="PREFIX",
+                        help="Also write a sparse feature x ChEBI matrix to PREFIX.npz with its index tables")
+    parser.add_argument("--intensities", default=None,
+                        help="Tab separated table of Lipid_ID and one column per sample")
+    parser.add_argument("--propagated", default=None, metavar="PREFIX",
+                        help="With --intensities, write the values aggregated up the ChEBI hierarchy "
+                             "to PREFIX_<aggregation>")
+    parser.add_argument("--aggregations", nargs="+", default=None, choices=lp.AGGREGATIONS)
+    parser.add_argument("--profile", default=None, metavar="JSON",
+                        help="Write wall time, peak memory, rows and counters of every stage to JSON")
+    parser.add_argument("--cprofile-dir", default=None,
+                        help="With --profile, also dump a cProfile file per stage into this directory")
+    args = parser.parse_args()
+
+    if args.profile is not None:
+        profiling.EnableProfiling(profile_dir=args.cprofile_dir)
+
+    if args.annotate_only:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        lp.AnnotateDataWithLipydStreaming(ReadFeatureTableChunks(args.features, args.modes,
+                                                                 args.chunksize or 100000),
+                                          args.output, tolerance=args.ppm, max_error=args.max_error,
+                                          top_k=args.top_k, scores=args.scores)
+    elif args.batch:
+        RunBatch(ReadBatchManifest(args.batch), output_dir=args.output_dir, n_jobs=args.n_jobs,
+                 backend=args.backend, table_format=args.format or "csv",
+                 tolerance=args.ppm, max_error=args.max_error, top_k=args.top_k)
+    else:
+        RunPipeline(features_file=args.features, modes_file=args.modes,
+                    curation_file=args.curation, output_file=args.output,
+                    cache_dir=args.cache_dir, n_jobs=args.n_jobs, backend=args.backend,
+                    table_format=args.format, chunksize=args.chunksize,
+                    tolerance=args.ppm, max_error=args.max_error, top_k=args.top_k, scores=args.scores,
+                    group=args.group, mz_tolerance=args.group_ppm, rt_tolerance=args.group_rt,
+                    link_modes=args.link_modes, incremental_dir=args.incremental,
+                    matrix_file=args.matrix, intensities_file=args.intensities,
+                    propagated_file=args.propagated, aggregations=args.aggregations)
+
+    if args.profile is not None:
+        profiling.DisableProfiling()
+        profiling.WriteProfile(args.profile)
@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import cProfile
+import functools
+import contextlib
+import tracemalloc
+import pandas as pd
+
+
+'''
+    Stage-level instrumentation: every instrumented stage records its wall
+    time, peak traced memory, rows in and out and its counters (database
+    lookups, graph nodes visited, ...) as a JSON-friendly record.
+    Profiling is off by default and costs a single dict lookup per call then
+'''
+
+_PROFILE = {"enabled": False,
+            "memory": False,
+            "profile_dir": None,
+            "started": None,
+            "records": [],
+            "stack": []}
+
+
+def EnableProfiling(memory=True, profile_dir=None):
+    # "profile_dir" turns on a cProfile dump (.prof) per stage
+    _PROFILE.update({"enabled": True,
+                     "memory": memory,
+                     "profile_dir": profile_dir,
+                     "started": time.time(),
+                     "records": [],
+                     "stack": []})
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+
+
+def DisableProfiling():
+    if _PROFILE["memory"] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _PROFILE["enabled"] = False
+    return GetProfile()
+
+
+def GetProfile():
+    return list(_PROFILE["records"])
+
+
+def WriteProfile(path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"started": _PROFILE["started"], "stages": GetProfile()}, f, indent=2)
+
+
+def Count(counter, n=1):
+    # Counters are added to the running stage and all of its parents
+    if not _PROFILE["enabled"]:
+        return
+    for record in _PROFILE["stack"]:
+        record["counters"][counter] = record["counters"].get(counter, 0) + int(n)
+
+
+@contextlib.contextmanager
+def Stage(name, rows_in=None):
+    if not _PROFILE["enabled"]:
+        yield {}
+        return
+
+    stack = _PROFILE["stack"]
+    record = {"stage": name,
+              "parent": stack[-1]["stage"] if stack else None,
+              "depth": len(stack),
+              "start": time.time() - _PROFILE["started"],
+              "wall_time": None,
+              "peak_memory": None,
+              "rows_in": rows_in,
+              "rows_out": None,
+              "counters": {}}
+
+    if _PROFILE["memory"]:
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1]["_peak"] = max(stack[-1]["_peak"], peak)
+        tracemalloc.reset_peak()
+        record["_start_memory"] = record["_peak"] = current
+
+    # Only one profiler can run at a time: the profile of the parent is
+    # paused, so every dump only holds the time spent in the stage itself
+    if _PROFILE["profile_dir"] is not None:
+        if stack and "_profiler" in stack[-1]:
+            stack[-1]["_profiler"].disable()
+        record["_profiler"] = cProfile.Profile()
+        record["_profiler"].enable()
+
+    stack.append(record)
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["wall_time"] = time.perf_counter() - started
+        stack.pop()
+
+        if "_profiler" in record:
+            profiler = record.pop("_profiler")
+            profiler.disable()
+            path = os.path.join(_PROFILE["profile_dir"],
+                                "%03d_%s.prof" % (len(_PROFILE["records"]), name.replace(":", "_")))
+            profiler.dump_stats(path)
+            record["cprofile"] = path
+            if stack and "_profiler" in stack[-1]:
+                stack[-1]["_profiler"].enable()
+
+        if _PROFILE["memory"]:
+            peak = max(record.pop("_peak"), tracemalloc.get_traced_memory()[1])
+            record["peak_memory"] = peak - record.pop("_start_memory")
+            if stack:
+                stack[-1]["_peak"] = max(stack[-1]["_peak"], peak)
+
+        _PROFILE["records"].append(record)
+
+
+def Profiled(name):
+    def Decorator(function):
+        @functools.wraps(function)
+        def Wrapper(*args, **kwargs):
+            if not _PROFILE["enabled"]:
+                return function(*args, **kwargs)
+
+            with Stage(name, rows_in=CountRows(list(args) + list(kwargs.values()))) as record:
+                result = function(*args, **kwargs)
+                record["rows_out"] = CountRows([result])
+            return result
+        return Wrapper
+    return Decorator
+
+
+def CountRows(values):
+    # Rows of the tables among the arguments (or the returned tuple)
+    rows = None
+    for value in values:
+        if isinstance(value, tuple):
+            value = CountRows(value)
+        elif isinstance(value, pd.DataFrame):
+            value = len(value)
+        else:
+            continue
+        if value is not None:
+            rows = (rows or 0) + value
+    return rows
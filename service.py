@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import socketserver
+import http.server
+import concurrent.futures
+import pandas as pd
+import lipid_preprocessing as lp
+
+
+'''
+    Annotation service: the adduct indexes, the SwissLipids graph with its
+    compiled summaries and the ChEBI ancestor closure are loaded once, and
+    feature batches posted over localhost HTTP (or a Unix socket) run the
+    annotation -> representatives -> ChEBI mapping chain against them.
+    Requests arriving within a short window are annotated together
+
+    python service.py --port 8765
+    curl -X POST localhost:8765/annotate -d '{"features": [{"Lipid_ID": "1", "MZ": 760.585, "Mode": "pos", "Adduct": "M+H"}]}'
+'''
+
+SERVICE_COLUMNS = ["Lipid_ID", "ChEBI_ID", "SwissLipids_ID", "Level",
+                   "Initial_SwissLipids_ID", "Depth", "Representative_ID"]
+REQUEST_COLUMNS = ["Lipid_ID", "MZ", "Mode"]
+
+
+class AnnotationService:
+    def __init__(self, levels=None, cache_dir="cache/lipyd", backend="networkx",
+                 batch_window=0.02, max_batch_rows=100000):
+        self.backend = backend
+        self.batch_window = batch_window
+        self.max_batch_rows = max_batch_rows
+
+        print("...Loading adduct indexes...")
+        self.indexes = lp.LoadAdductIndexes(levels=levels, cache_dir=cache_dir)
+
+        print("...Compiling graph summaries and ChEBI ancestor closure...")
+        self.state = lp.CompileReferenceState(backend=backend)
+
+        self.requests = queue.Queue()
+        self.worker = threading.Thread(target=self.RunBatches, daemon=True)
+        self.worker.start()
+
+    def Submit(self, features):
+        # "features" is formatted like this: --- Lipid_ID, MZ, Mode --- and optionally "Adduct"
+        future = concurrent.futures.Future()
+        self.requests.put((features, future))
+        return future.result()
+
+    def RunBatches(self):
+        while True:
+            # Collecting the requests which arrive within the window, a
+            # malformed request only fails its own future
+            batch = []
+            rows = 0
+            deadline = None
+            while rows < self.max_batch_rows:
+                if deadline is None:
+                    features, future = self.requests.get()
+                    deadline = time.monotonic() + self.batch_window
+                else:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        features, future = self.requests.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+
+                try:
+                    features = self.ValidateRequest(features)
+                except Exception as error:
+                    future.set_exception(error)
+                    continue
+                batch.append((features, future))
+                rows += len(features)
+            if not batch:
+                continue
+
+            try:
+                results = self.ProcessBatch([features for features, _ in batch])
+            except Exception as error:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(error)
+                else:
+                    # Retrying the requests one by one to isolate the failing one
+                    self.ProcessSeparately(batch)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def ProcessSeparately(self, batch):
+        for features, future in batch:
+            try:
+                future.set_result(self.ProcessBatch([features])[0])
+            except Exception as error:
+                future.set_exception(error)
+
+    def ValidateRequest(self, features):
+        if not isinstance(features, pd.DataFrame):
+            raise TypeError("features must be a table")
+        missing = set(REQUEST_COLUMNS) - set(features.columns)
+        if missing:
+            raise KeyError(", ".join(sorted(missing)))
+        features = features.copy()
+        features["MZ"] = pd.to_numeric(features.MZ)
+        unknown = set(features.Mode) - {"pos", "neg"}
+        if unknown:
+            raise ValueError("unknown modes: %s" % ", ".join(sorted(map(str, unknown))))
+        return features
+
+    def ProcessBatch(self, batch):
+        # Lipid IDs are only unique within a request, so they are prefixed
+        # with the number of the request inside the batch. Adduct constraints
+        # are applied per request, only when all of its features declare one
+        features = pd.concat([features.assign(Request=i, Constrained=self.HasAdducts(features))
+                              for i, features in enumerate(batch)],
+                             ignore_index=True)
+        features["Original_ID"] = features.Lipid_ID
+        features["Lipid_ID"] = features.Request.astype(str) + "/" + features.Lipid_ID.astype(str)
+
+        annotation = self.Annotate(features)
+        annotation = annotation.merge(features[["Lipid_ID", "Request"]], how="left")
+
+        # The representatives of a request only depend on its own SwissLipids
+        # IDs, so they are resolved per request against the compiled summaries
+        back_mapped = []
+        for i in range(len(batch)):
+            request_annotation = annotation[annotation.Request == i].drop(columns=["Request"])
+            repr_to_swl = lp.GetRepresentatives(request_annotation, backend=self.backend, memo_dir=None,
+                                                graph=self.state["graph"], summary=self.state["summary"],
+                                                no_species_summary=self.state["no_species_summary"])
+            representatives = lp.SelectRepresentatives(request_annotation, repr_to_swl)
+            back_mapped.append(lp.RepresentativesToLipids(representatives, repr_to_swl))
+
+        mapped = lp.MappingToGraph(pd.concat(back_mapped, ignore_index=True), closure=self.state["closure"])
+        mapped = mapped.merge(features[["Lipid_ID", "Request", "Original_ID"]], how="left")
+
+        results = []
+        for i in range(len(batch)):
+            result = mapped[mapped.Request == i].copy()
+            result["Lipid_ID"] = result.Original_ID
+            results.append(result[SERVICE_COLUMNS].reset_index(drop=True))
+        return results
+
+    def HasAdducts(self, features):
+        return "Adduct" in features.columns and bool(features.Adduct.notnull().all())
+
+    def Annotate(self, features):
+        annotation = []
+        for constrained, group in list(features.groupby("Constrained", sort=False)) or [(False, features)]:
+            adducts = group[["Lipid_ID", "Adduct"]] if constrained else None
+
+            positive_data, negative_data = lp.SeparatePosNegModes(group[["Lipid_ID", "MZ", "Mode"]])
+            annotation.append(lp.GetAnnotationBatch(positive_data, index=self.indexes['pos'], adducts=adducts))
+            annotation.append(lp.GetAnnotationBatch(negative_data, index=self.indexes['neg'], adducts=adducts))
+        return pd.concat(annotation, ignore_index=True)
+
+
+'''
+    HTTP interface: POST /annotate with {"features": [{...}, ...]} returns
+    {"results": [{...}, ...]}, GET /health reports that the service is up
+'''
+
+
+class AnnotationRequestHandler(http.server.BaseHTTPRequestHandler):
+    service = None
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self.SendJSON(404, {"error": "not found"})
+        self.SendJSON(200, {"status": "ok"})
+
+    def do_POST(self):
+        if self.path != "/annotate":
+            return self.SendJSON(404, {"error": "not found"})
+
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            features = pd.DataFrame(body["features"])
+            missing = {"Lipid_ID", "MZ", "Mode"} - set(features.columns)
+            if missing:
+                raise KeyError(", ".join(sorted(missing)))
+        except (ValueError, KeyError, TypeError) as error:
+            return self.SendJSON(400, {"error": "bad request: %s" % error})
+
+        started = time.perf_counter()
+        try:
+            result = self.service.Submit(features)
+        except Exception as error:
+            return self.SendJSON(500, {"error": "%s: %s" % (type(error).__name__, error)})
+        self.SendJSON(200, {"results": json.loads(result.to_json(orient="records")),
+                            "elapsed": time.perf_counter() - started})
+
+    def SendJSON(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def Serve(service, host="127.0.0.1", port=8765, socket_path=None):
+    handler = type("Handler", (AnnotationRequestHandler,), {"service": service})
+
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, handler)
+        print("...Serving on %s..." % socket_path)
+    else:
+        server = http.server.ThreadingHTTPServer((host, port), handler)
+        print("...Serving on http://%s:%d..." % (host, port))
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Long-running lipid annotation service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", default=None, help="Serve on a Unix socket instead of TCP")
+    parser.add_argument("--cache-dir", default="cache/lipyd")
+    parser.add_argument("--backend", default="networkx", choices=["networkx", "csr", "snapshot"])
+    parser.add_argument("--batch-window", type=float, default=0.02,
+                        help="Seconds to wait for concurrent requests to annotate together")
+    parser.add_argument("--max-batch-rows", type=int, default=100000)
+    args = parser.parse_args()
+
+    Serve(AnnotationService(cache_dir=args.cache_dir, backend=args.backend,
+                            batch_window=args.batch_window, max_batch_rows=args.max_batch_rows),
+          host=args.host, port=args.port, socket_path=args.socket)